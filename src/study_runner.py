@@ -1,33 +1,42 @@
 # to run all variants one after another:
 # python study_runner.py PATH_TO_CONFIG [if_study_exists=fail|delete|load]
-
-# necessary for determinism:
-import os
-
-os.environ["CUBLAS_WORKSPACE_CONFIG"] = ":4096:8"
-# os.environ['CUBLAS_WORKSPACE_CONFIG'] = ":16:8"  # less mem but slower
+# to run them in parallel, e.g. 4 workers on 2 GPUs:
+# python study_runner.py --config-path PATH_TO_CONFIG --workers 4 --devices 0,1
 
 import argparse
 import logging
+import multiprocessing
 import sys
 from types import SimpleNamespace
 
 import torch as pt
 import yaml
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from optuna.study import MaxTrialsCallback
+from transformers import AutoTokenizer
 
 from unlearning_methods.circuit_breakers import circuit_breakers
 from unlearning_methods.circuit_breakers_no_lora import circuit_breakers_no_lora
 from unlearning_methods.surgical_irreversible_unlearning import (
     surgical_irreversible_unlearning,
 )
+from unlearning_methods.surgical_irreversible_unlearning_ensemble import (
+    surgical_irreversible_unlearning_ensemble,
+)
 from unlearning_methods.surgical_irreversible_unlearning_lora import (
     surgical_irreversible_unlearning_lora,
 )
 from unlearning_methods.tar import tar
-from utils.data_loading import CachedBatches, dataset_loaders
+from utils.data_loading import CachedBatches, PrefetchedBatches, get_token_store
 from utils.git_and_reproducibility import *
-from utils.model_operations import relearn
+from utils.loss_fns import clear_activation_caches, set_lm_head_chunk_size
+from utils.model_operations import get_base_model, relearn, save_model_store
+from utils.profiling import (
+    maybe_profile,
+    record_trial,
+    set_trial_stats,
+    start_trial,
+    stop_trial,
+)
 from utils.training import *
 
 logging.basicConfig(
@@ -38,10 +47,7 @@ logging.basicConfig(
 )
 
 
-def run_study(storage, config_path, variant_num, if_study_exists="fail", n_trials=None):
-    assert if_study_exists in ["fail", "delete", "load", "load-remaining"]
-    print(f"{config_path=} {variant_num=} {if_study_exists=} {n_trials=}")
-
+def load_variant_config(config_path, variant_num, n_trials=None):
     # load YAML configuration
     with open(config_path, "r") as f:
         full_config = yaml.safe_load(f)
@@ -64,26 +70,65 @@ def run_study(storage, config_path, variant_num, if_study_exists="fail", n_trial
         f"{config.forget_set_name}"
         f"|{Path(config_path).stem}|{variant_name}"
     )
+    return config, relearn_config, hyperparam_ranges, study_name
+
+
+def run_study(
+    storage,
+    config_path,
+    variant_num,
+    if_study_exists="fail",
+    n_trials=None,
+    device="cuda",
+    worker_num=None,
+):
+    assert if_study_exists in ["fail", "delete", "load", "load-remaining"]
+    print(f"{config_path=} {variant_num=} {if_study_exists=} {n_trials=}")
+
+    config, relearn_config, hyperparam_ranges, study_name = load_variant_config(
+        config_path, variant_num, n_trials
+    )
     print(f"{study_name=}")
     print(f"{hyperparam_ranges=}")
 
-    pt.set_default_device("cuda")
+    # before CUDA is initialized, as in strict mode it configures cuBLAS
+    set_determinism(getattr(config, "determinism", "strict"))
+    if device != "cuda":
+        pt.cuda.set_device(device)
+    pt.set_default_device(device)
+    set_precision(getattr(config, "precision", "fp32"))
+    set_lm_head_chunk_size(getattr(config, "lm_head_chunk_size", None))
 
     # load datasets
     set_seeds(42)
     tokenizer = AutoTokenizer.from_pretrained(config.model_id)
-    retain_set = dataset_loaders[config.retain_set_name](tokenizer)
-    forget_set = dataset_loaders[config.forget_set_name](tokenizer)
-    retain_batches = CachedBatches(retain_set["train"], config.batch_size)
-    forget_batches = CachedBatches(forget_set["train"], config.batch_size)
-    retain_val_batches = CachedBatches(retain_set["validation"], config.batch_size)
-    forget_val_batches = CachedBatches(forget_set["validation"], config.batch_size)
+
+    # pack short examples into rows, instead of discarding them
+    pack = getattr(config, "pack_sequences", False)
+
+    def load_batches(set_name, split):
+        token_store = get_token_store(set_name, tokenizer, split, pack)
+        batches = CachedBatches(
+            token_store,
+            config.batch_size,
+            getattr(config, "max_device_batches", None),
+        )
+        if getattr(config, "prefetch_batches", 0):
+            batches = PrefetchedBatches(batches, config.prefetch_batches)
+        return batches
+
+    # cached activations are keyed by the batches of the previous study
+    clear_activation_caches()
+    retain_batches = load_batches(config.retain_set_name, "train")
+    forget_batches = load_batches(config.forget_set_name, "train")
+    retain_val_batches = load_batches(config.retain_set_name, "validation")
+    forget_val_batches = load_batches(config.forget_set_name, "validation")
     r_eval = next(iter(retain_val_batches))
     f_eval = next(iter(forget_val_batches))
 
-    allowed_r_loss = eval_(
-        AutoModelForCausalLM.from_pretrained(config.model_id), f_eval, r_eval
-    )["retain_loss"]
+    allowed_r_loss = eval_(get_base_model(config.model_id), f_eval, r_eval)[
+        "retain_loss"
+    ]
     allowed_r_loss += getattr(config, "retain_loss_budget", 0)
 
     unlearning_func = dict(
@@ -94,7 +139,7 @@ def run_study(storage, config_path, variant_num, if_study_exists="fail", n_trial
         tar=tar,
     )[config.method_name]
 
-    def objective(trial):
+    def suggest_hyperparams(trial):
         # construct hyperparams
         hyperparams = dict()
         for hp_name, distribution in hyperparam_ranges.items():
@@ -103,11 +148,85 @@ def run_study(storage, config_path, variant_num, if_study_exists="fail", n_trial
                 hyperparams[hp_name] = trial.suggest_float(hp_name, low, high, log=log)
             else:
                 hyperparams[hp_name] = distribution
-        hyperparams = SimpleNamespace(**hyperparams)
         logging.info(f"trial {trial.number} - {trial.params}")
+        return SimpleNamespace(**hyperparams)
+
+    def objective(trial):
+        hyperparams = suggest_hyperparams(trial)
+
+        # per-phase times, tokens/sec and peak memory go to the trial's user attrs
+        start_trial()
+        try:
+            with maybe_profile(config, trial):
+                set_seeds(42)
+                model = unlearning_func(
+                    hyperparams,
+                    config,
+                    retain_batches,
+                    forget_batches,
+                    f_eval,
+                    r_eval,
+                    allowed_r_loss,
+                    trial,
+                )
+
+                set_seeds(42)
+                forget_losses = relearn(
+                    model,
+                    relearn_config,
+                    retain_val_batches,
+                    forget_val_batches,
+                    trial=trial,
+                    step_offset=config.unlearn_steps,
+                )
+        finally:
+            record_trial(trial)
+
+        # use min rather than last, in case it anomalously increases
+        forget_loss = min(forget_losses)
+        return forget_loss
 
+    def optimize_in_ensembles(n_trials):
+        # like study.optimize(objective), but unlearning runs ensemble_size trials at once
+        assert config.method_name == "surgical_irreversible_unlearning"
+        while n_trials > 0:
+            trials = []
+            for _ in range(min(config.ensemble_size, n_trials)):
+                # like MaxTrialsCallback, as other workers may be filling the study
+                if if_study_exists == "load-remaining":
+                    if len(study.trials) >= config.n_trials:
+                        break
+                trials.append(study.ask())
+            if not trials:
+                break
+            n_trials -= len(trials)
+
+            told = []
+            # the trace covers the whole batch, if one of its trials is profiled
+            profiled = [
+                t for t in trials if t.number == getattr(config, "profile_trial", None)
+            ]
+            try:
+                with maybe_profile(config, (profiled or trials)[0]):
+                    run_ensemble(trials, told)
+            finally:
+                # so that on errors or interrupts no trial stays RUNNING in the storage
+                for trial in trials:
+                    if trial not in told:
+                        study.tell(trial, state=optuna.trial.TrialState.FAIL)
+
+    def run_ensemble(trials, told):
+        def tell(trial, *args, **kwargs):
+            study.tell(trial, *args, **kwargs)
+            told.append(trial)
+
+        hyperparams = [suggest_hyperparams(trial) for trial in trials]
+
+        # the ensemble run is shared, so its stats are recorded once, and added to
+        # each trial's own relearning stats
+        start_trial()
         set_seeds(42)
-        model = unlearning_func(
+        results = surgical_irreversible_unlearning_ensemble(
             hyperparams,
             config,
             retain_batches,
@@ -115,16 +234,40 @@ def run_study(storage, config_path, variant_num, if_study_exists="fail", n_trial
             f_eval,
             r_eval,
             allowed_r_loss,
+            trials,
         )
+        ensemble_stats = stop_trial()
 
-        set_seeds(42)
-        forget_losses = relearn(
-            model, relearn_config, retain_val_batches, forget_val_batches
-        )
+        for trial, interven_state in zip(trials, results):
+            if interven_state is None:
+                set_trial_stats(trial, ensemble_stats)
+                tell(trial, state=optuna.trial.TrialState.PRUNED)
+                continue
+            model = get_base_model(config.model_id)
+            for name, data in interven_state.items():
+                model.get_parameter(name).data.copy_(data)
 
-        # use min rather than last, in case it anomalously increases
-        forget_loss = min(forget_losses)
-        return forget_loss
+            start_trial()
+            pruned = False
+            try:
+                set_seeds(42)
+                forget_losses = relearn(
+                    model,
+                    relearn_config,
+                    retain_val_batches,
+                    forget_val_batches,
+                    trial=trial,
+                    step_offset=config.unlearn_steps,
+                )
+            except optuna.TrialPruned:
+                pruned = True
+            finally:
+                # before telling, as finished trials can't be updated
+                record_trial(trial, ensemble_stats)
+            if pruned:
+                tell(trial, state=optuna.trial.TrialState.PRUNED)
+                continue
+            tell(trial, min(forget_losses))
 
     if if_study_exists == "delete":
         delete_study_if_exists(study_name, storage)
@@ -133,26 +276,77 @@ def run_study(storage, config_path, variant_num, if_study_exists="fail", n_trial
         storage=storage,
         direction="maximize",
         load_if_exists=(if_study_exists in ["load", "load-remaining"]),
+        pruner=get_pruner(config),
     )
-    save_file_and_attach_logger(config_path, study.study_name)
+    log_name = study.study_name
+    if worker_num is not None:
+        log_name += f" worker{worker_num}"
+    save_file_and_attach_logger(config_path, log_name)
     study.set_metric_names(["forget_loss"])
     study.set_user_attr("commit_hash", commit_hash())
     study.set_user_attr("is_repo_clean", is_repo_clean())
     for k, v in config.__dict__.items():
         study.set_user_attr(k, v)
+    # record it even when left default, as non-strict results aren't reproducible
+    study.set_user_attr("determinism", get_determinism())
 
     n_trials = config.n_trials
+    callbacks = []
     if if_study_exists == "load-remaining":
         # run remaining trials
         n_trials = max(0, config.n_trials - len(study.trials))
+        # other workers may be running this study too, so stop at the total count
+        callbacks.append(MaxTrialsCallback(config.n_trials, states=None))
 
     try:
         print(f"{n_trials=}")
-        study.optimize(objective, n_trials=n_trials)
+        if getattr(config, "ensemble_size", 1) > 1:
+            optimize_in_ensembles(n_trials)
+        else:
+            study.optimize(objective, n_trials=n_trials, callbacks=callbacks)
     except KeyboardInterrupt:
         pass
 
 
+def prepare_study(storage, config_path, variant_num, if_study_exists, n_trials=None):
+    """
+    Create the study, its token stores and the model store, before the workers
+    attach to them.
+    """
+    config, _, _, study_name = load_variant_config(config_path, variant_num, n_trials)
+    if if_study_exists == "delete":
+        delete_study_if_exists(study_name, storage)
+    optuna.create_study(
+        study_name=study_name,
+        storage=storage,
+        direction="maximize",
+        load_if_exists=(if_study_exists == "load-remaining"),
+    )
+    # build them here once, so that workers only memory-map them
+    tokenizer = AutoTokenizer.from_pretrained(config.model_id)
+    pack = getattr(config, "pack_sequences", False)
+    for set_name in [config.retain_set_name, config.forget_set_name]:
+        for split in ["train", "validation"]:
+            get_token_store(set_name, tokenizer, split, pack)
+    save_model_store(config.model_id)
+
+
+def run_worker(db_url, config_path, variant_nums, worker_num, device, n_trials=None):
+    storage = get_storage(db_url)
+    # each worker starts from a different variant, so that variants are interleaved
+    for i in range(len(variant_nums)):
+        variant_num = variant_nums[(worker_num + i) % len(variant_nums)]
+        run_study(
+            storage,
+            config_path,
+            variant_num,
+            "load-remaining",
+            n_trials,
+            device,
+            worker_num,
+        )
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Run unlearning studies")
     parser.add_argument(
@@ -182,6 +376,18 @@ if __name__ == "__main__":
         action="store_true",
         help="Allow running even if the git repo has uncommitted changes (default: False)",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes sharing the studies (default: 1). With more than one, each study runs n_trials in total, spread across the workers.",
+    )
+    parser.add_argument(
+        "--devices",
+        type=str,
+        default="0",
+        help="Comma-separated CUDA devices to assign workers to, round-robin (default: 0). A single worker runs on the first one.",
+    )
     args = parser.parse_args()
 
     db_url = json.load(open("secret.json"))["db_url"]
@@ -191,7 +397,53 @@ if __name__ == "__main__":
     with open(args.config_path, "r") as f:
         full_config = yaml.safe_load(f)
 
-    if args.variant_num is None:
+    devices = args.devices.split(",")
+    # a single process runs on the first one
+    device = f"cuda:{devices[0]}"
+    if args.workers == 1 and len(devices) > 1:
+        logging.warning(f"with one worker only {device} is used")
+
+    if args.workers > 1:
+        # ! run variants in parallel worker processes, all attached to the same storage
+        assert args.if_study_exists in ["fail", "delete", "load-remaining"]
+        if not args.allow_dirty_repo:
+            assert is_repo_clean()
+        if args.variant_num is None:
+            variant_nums = list(range(len(full_config["variants"])))
+        else:
+            variant_nums = [args.variant_num]
+        for variant_num in variant_nums:
+            prepare_study(
+                storage,
+                args.config_path,
+                variant_num,
+                args.if_study_exists,
+                args.n_trials,
+            )
+
+        ctx = multiprocessing.get_context("spawn")
+        workers = [
+            ctx.Process(
+                target=run_worker,
+                args=(
+                    db_url,
+                    args.config_path,
+                    variant_nums,
+                    worker_num,
+                    f"cuda:{devices[worker_num % len(devices)]}",
+                    args.n_trials,
+                ),
+            )
+            for worker_num in range(args.workers)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        failed = [i for i, worker in enumerate(workers) if worker.exitcode != 0]
+        if failed:
+            sys.exit(f"workers {failed} failed, see their logs above")
+    elif args.variant_num is None:
         # ! run all variants one after another
         for variant_num in range(len(full_config["variants"])):
             if not args.allow_dirty_repo:
@@ -202,6 +454,7 @@ if __name__ == "__main__":
                 variant_num,
                 args.if_study_exists,
                 args.n_trials,
+                device,
             )
     else:
         # ! run single variant
@@ -213,4 +466,5 @@ if __name__ == "__main__":
             args.variant_num,
             args.if_study_exists,
             args.n_trials,
+            device,
         )
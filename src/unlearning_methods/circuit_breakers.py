@@ -2,9 +2,13 @@ import logging
 
 import torch as pt
 from peft import LoraConfig, get_peft_model
-from transformers import AutoModelForCausalLM
 
-from utils.loss_fns import circuit_breaker_forget_loss, circuit_breaker_retain_loss
+from utils.loss_fns import (
+    circuit_breaker_forget_loss,
+    circuit_breaker_retain_loss,
+    get_activation_cache,
+)
+from utils.model_operations import get_base_model
 from utils.training import eval_
 
 
@@ -16,6 +20,9 @@ def compute_loss(
     target_layers,
     retaining_rate,
     unlearning_rate,
+    forget_cache,
+    retain_cache,
+    frozen_forward,
 ):
 
     # Those are pretty much arbitrary, the important thing is that retain_coeff increases as the training progresses and forget_coeff decreases.
@@ -23,13 +30,22 @@ def compute_loss(
     forget_coeff = unlearning_rate * (1 - percent_done / 2)
 
     if retain_coeff > 0:
-        retain_loss = circuit_breaker_retain_loss(model, retain_input_ids, LoRA=True)
+        retain_loss = circuit_breaker_retain_loss(
+            model,
+            retain_input_ids,
+            LoRA=True,
+            frozen_hidden=retain_cache.get(retain_input_ids, frozen_forward),
+        )
     else:
         retain_loss = 0
 
     if forget_coeff > 0:
         forget_loss = circuit_breaker_forget_loss(
-            model, forget_input_ids, target_layers, LoRA=True
+            model,
+            forget_input_ids,
+            target_layers,
+            LoRA=True,
+            frozen_hidden=forget_cache.get(forget_input_ids, frozen_forward),
         )
     else:
         forget_loss = 0
@@ -40,11 +56,19 @@ def compute_loss(
 
 
 def circuit_breakers(
-    h, config, retain_batches, forget_batches, f_eval, r_eval, allowed_f_loss
+    h,
+    config,
+    retain_batches,
+    forget_batches,
+    f_eval,
+    r_eval,
+    allowed_f_loss,
+    trial=None,
 ):
     logging.info(f"Running circuit breaker with params: {h}")
 
-    model = AutoModelForCausalLM.from_pretrained(config.model_id)
+    # peft modifies the model in place, so it needs its own copy
+    model = get_base_model(config.model_id, reuse=False)
 
     # Add LoRA
     ret_lora_config = dict(lora_dropout=0.05, target_modules="all-linear")
@@ -55,6 +79,18 @@ def circuit_breakers(
     num_layers = lora_model.config.num_hidden_layers
     target_layers = [num_layers // 2]
 
+    def frozen_forward(input_ids):
+        # with adapters disabled, it's the base model
+        lora_model.eval()
+        with lora_model.disable_adapter():
+            output = lora_model(input_ids, output_hidden_states=True)
+        lora_model.train()
+        return output.hidden_states
+
+    # base model activations are the same for all trials, so they're cached
+    forget_cache = get_activation_cache(config, layers=target_layers)
+    retain_cache = get_activation_cache(config)
+
     optimizer = pt.optim.SGD(lora_model.parameters(), lr=1)
 
     retain_iter = iter(retain_batches)
@@ -74,6 +110,9 @@ def circuit_breakers(
             target_layers,
             h.retaining_rate,
             h.unlearning_rate,
+            forget_cache,
+            retain_cache,
+            frozen_forward,
         )
 
         loss.backward()
@@ -83,6 +122,6 @@ def circuit_breakers(
         # Evaluation
         _passes_done = (loop_num + 1) * passes_per_loop
         if _passes_done % 60 == 0:
-            eval_(model, f_eval, r_eval, allowed_f_loss, _passes_done)
+            eval_(model, f_eval, r_eval, allowed_f_loss, _passes_done, trial)
 
     return model
@@ -1,21 +1,25 @@
-from copy import deepcopy
-
 import torch as pt
-from transformers import AutoModelForCausalLM
 
-from utils.loss_fns import circuit_breaker_forget_loss, circuit_breaker_retain_loss
+from utils.loss_fns import (
+    circuit_breaker_forget_loss,
+    circuit_breaker_retain_loss,
+    get_activation_cache,
+)
+from utils.model_operations import get_base_hidden_states, get_base_model
 from utils.training import eval_
 
 
 def compute_loss(
     percent_done,
     model,
-    frozen_model,
     forget_input_ids,
     retain_input_ids,
     target_layers,
     retaining_rate,
     unlearning_rate,
+    forget_cache,
+    retain_cache,
+    frozen_forward,
 ):
 
     # Those are pretty much arbitrary, the important thing is that retain_coeff increases as the training progresses and forget_coeff decreases.
@@ -23,13 +27,20 @@ def compute_loss(
     forget_coeff = unlearning_rate * (1 - percent_done / 2)
 
     if retain_coeff > 0:
-        retain_loss = circuit_breaker_retain_loss(model, retain_input_ids, frozen_model)
+        retain_loss = circuit_breaker_retain_loss(
+            model,
+            retain_input_ids,
+            frozen_hidden=retain_cache.get(retain_input_ids, frozen_forward),
+        )
     else:
         retain_loss = 0
 
     if forget_coeff > 0:
         forget_loss = circuit_breaker_forget_loss(
-            model, forget_input_ids, target_layers, frozen_model
+            model,
+            forget_input_ids,
+            target_layers,
+            frozen_hidden=forget_cache.get(forget_input_ids, frozen_forward),
         )
     else:
         forget_loss = 0
@@ -40,17 +51,28 @@ def compute_loss(
 
 
 def circuit_breakers_no_lora(
-    h, config, retain_batches, forget_batches, f_eval, r_eval, allowed_f_loss
+    h,
+    config,
+    retain_batches,
+    forget_batches,
+    f_eval,
+    r_eval,
+    allowed_f_loss,
+    trial=None,
 ):
-    # Create main model and frozen copy
-    model = AutoModelForCausalLM.from_pretrained(config.model_id)
-
-    frozen_model = deepcopy(model)
-    frozen_model.eval()
+    model = get_base_model(config.model_id)
 
     num_layers = model.config.num_hidden_layers
     target_layers = [num_layers // 2]
 
+    # instead of keeping a frozen copy of the model, base model activations
+    # are computed from its pristine weights, and cached for all trials
+    def frozen_forward(input_ids):
+        return get_base_hidden_states(model, config.model_id, input_ids)
+
+    forget_cache = get_activation_cache(config, layers=target_layers)
+    retain_cache = get_activation_cache(config)
+
     optimizer = pt.optim.SGD(model.parameters(), lr=1)
 
     retain_iter = iter(retain_batches)
@@ -65,12 +87,14 @@ def circuit_breakers_no_lora(
         loss = compute_loss(
             loop_num / (config.unlearn_steps // passes_per_loop),
             model,
-            frozen_model,
             f_input_ids,
             r_input_ids,
             target_layers,
             h.retaining_rate,
             h.unlearning_rate,
+            forget_cache,
+            retain_cache,
+            frozen_forward,
         )
 
         loss.backward()
@@ -79,6 +103,6 @@ def circuit_breakers_no_lora(
         # ! eval current loss
         _passes_done = (loop_num + 1) * passes_per_loop
         if _passes_done % 60 == 0:
-            eval_(model, f_eval, r_eval, allowed_f_loss, _passes_done)
+            eval_(model, f_eval, r_eval, allowed_f_loss, _passes_done, trial)
 
     return model
@@ -39,7 +39,9 @@ def unlearning_func(
 
     # use several circuits, mixed together; load circuits and construct to_forget
     for circuit_name, strength in config.circuit_names:
-        circuit = get_circuit(config, forget_batches, circuit_name)
+        circuit = get_circuit(
+            config, forget_batches, circuit_name, config.target_modules
+        )
         circuit = filter_and_normalize_circuit(circuit, config.target_modules)
         for p in interven_params:
             if p.param_name in circuit:
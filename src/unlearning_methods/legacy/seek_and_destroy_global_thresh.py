@@ -82,6 +82,20 @@ def unlearning_func(
     # Get threshold for forgetting
     f_threshold = get_thresh(f_quantile, [p.to_forget.abs() for p in interven_params])
 
+    # to_forget and f_threshold are fixed, so the forget mask is too; keep only the
+    # flat indices of the chosen weights, and gather their scores into one buffer
+    offset = 0
+    for p in interven_params:
+        p.forget_idx = (p.to_forget.abs() > f_threshold).flatten().nonzero()[:, 0]
+        p.forget_vals = p.to_forget.flatten()[p.forget_idx]
+        p.forget_sign = p.forget_vals.sign()
+        p.buf_slice = slice(offset, offset + len(p.forget_idx))
+        offset += len(p.forget_idx)
+    flipped_scores = pt.empty(offset)
+    unlearn_mask = pt.empty(offset, dtype=pt.bool)
+    update = pt.empty(offset)
+    d_threshold = None
+
     # Require grad for all intervene params
     for param in model.parameters():
         param.requires_grad = False
@@ -112,24 +126,23 @@ def unlearning_func(
             continue
 
         # Unlearning step with two-stage masking
-        flipped_scores = []
+        # First choose the most important weights for forgetting (precomputed)
         for p in interven_params:
-            # First choose the most important weights for forgetting
-            mask = p.to_forget.abs() > f_threshold
             # Then from them, choose the ones least disrupting
-            flipped_disr = p.disruption_score * p.to_forget.sign()
-            flipped_scores.append(flipped_disr[mask])
-        d_threshold = get_thresh(r_quantile, flipped_scores)
+            flipped = flipped_scores[p.buf_slice]
+            scores = p.disruption_score.flatten()
+            pt.index_select(scores, 0, p.forget_idx, out=flipped)
+            flipped *= p.forget_sign
+        # scores change only slightly between steps, so start from the last threshold
+        d_threshold = get_thresh(r_quantile, [flipped_scores], prev_thresh=d_threshold)
+        pt.gt(flipped_scores, d_threshold, out=unlearn_mask)
 
         for p in interven_params:
-            # recompute these two
-            mask = p.to_forget.abs() > f_threshold
-            flipped_disr = p.disruption_score * p.to_forget.sign()
-
             # ! unlearn
-            flipped_disr[~mask] = float("-inf")
-            mask = mask & (flipped_disr > d_threshold)
-            p.data -= mask * unlearning_rate * p.to_forget
+            p_update = update[p.buf_slice]
+            pt.mul(unlearn_mask[p.buf_slice], p.forget_vals, out=p_update)
+            p_update *= -unlearning_rate
+            p.data.view(-1).index_add_(0, p.forget_idx, p_update)
 
             # ! retain
             p.grad[p.grad.sign() != p.to_forget.sign()] *= retain_consistency
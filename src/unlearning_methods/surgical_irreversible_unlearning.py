@@ -1,19 +1,36 @@
-from copy import deepcopy
 import logging
+from types import SimpleNamespace
 
 import torch as pt
-from transformers import AutoModelForCausalLM
 
 from utils.loss_fns import *
+from utils.model_operations import get_base_hidden_states, get_base_model
+from utils.profiling import count_tokens, phase
+from utils.surgical_unlearner import SurgicalUnlearner
 from utils.training import *
 
+# per-process cache of the captured loop step, so that one CUDA graph serves all the
+# trials: model_id -> SimpleNamespace with the graph and the buffers it uses
+_graphed_steps = {}
+# loops run eagerly before capturing, so that lazy initializations happen outside it
+_warmup_loops = 3
+
 
 def surgical_irreversible_unlearning(
-    h, config, retain_batches, forget_batches, f_eval, r_eval, allowed_r_loss
+    h,
+    config,
+    retain_batches,
+    forget_batches,
+    f_eval,
+    r_eval,
+    allowed_r_loss,
+    trial=None,
 ):
     h.fork_every_n_loops = int(h.fork_every_n_loops)
+    # capture the whole loop step in a CUDA graph, as it's launch-bound for small models
+    graphed = getattr(config, "graphed_step", False)
 
-    model = AutoModelForCausalLM.from_pretrained(config.model_id)
+    model = get_base_model(config.model_id)
     model.config.use_cache = False
 
     clip_at = h.additional_param if config.additional_param_name == "clip_at" else 0
@@ -24,129 +41,224 @@ def surgical_irreversible_unlearning(
         for name, p in model.named_parameters()
         if any(f"{m}.weight" in name for m in config.target_modules)
     ]
-    total_interven_numel = sum(p.numel() for p in interven_params)
 
     # require grads only on intervened params
     for p in model.parameters():
         p.requires_grad = id(p) in [id(p) for p in interven_params]
+    # intervened params and their buffers stay in fp32, whatever the precision
+    cast_frozen_params(model, interven_params)
 
-    for p in interven_params:
-        p.retain_acc = pt.zeros_like(p.data)
-        if config.additional_param_name == "forget_momentum":
-            p.forget_acc = pt.zeros_like(p.data)
-        p.base_data = p.data.clone().detach()
-
-    # ! unlearning loop
-    logging.info("step      base_f      base_r")
-    retain_iter = iter(retain_batches)
-    forget_iter = iter(forget_batches)
+    hyperparams = dict(
+        retaining_rate=h.retaining_rate,
+        unlearning_rate=h.unlearning_rate,
+        retain_momentum=h.retain_momentum,
+        adv_lr=h.adv_lr,
+        adv_decay=h.adv_decay,
+    )
+    additional = {
+        "forget_momentum": "forget_momentum",
+        "discard_growing_weights": "growing_weights_scale",
+        "adv_update": "adv_update_scale",
+    }
+    if config.additional_param_name in additional:
+        hyperparams[additional[config.additional_param_name]] = h.additional_param
+    if config.additional_param_name == "adv_update":
+        assert config.train_adversary  # otherwise it may be wrong
 
-    if config.additional_param_name == "rep_eng_retain_lr":
-        frozen_model = deepcopy(model)
-        frozen_model.eval()
+    use_rep_eng = config.additional_param_name == "rep_eng_retain_lr"
+    if use_rep_eng:
+        assert not graphed, "the activation cache lookup can't be captured"
+        # the frozen model is the base model, so its activations can be shared by trials
+        # and only the layers the loss compares need to be kept (by default all)
+        rep_eng_layers = getattr(config, "rep_eng_layers", None)
+        frozen_hidden_cache = get_activation_cache(config, layers=rep_eng_layers)
 
-    # ! unlearning loop
-    passes_per_loop = (
-        4
-        + int(config.train_adversary)
-        # note that now it's inefficient and uses two additional passes
-        # but in principle could be optimized to reuse outputs and only need
-        # additional forward pass on the frozen model
-        + int(config.additional_param_name == "rep_eng_retain_lr")
-    )
-    _eval_counter = 0
-    assert config.unlearn_steps % passes_per_loop == 0
-    for loop_num in range(config.unlearn_steps // passes_per_loop):
-        model.train()
-        f_input_ids = next(forget_iter)
-        r_input_ids = next(retain_iter)
+        def frozen_forward(input_ids):
+            return get_base_hidden_states(model, config.model_id, input_ids)
 
-        if loop_num % h.fork_every_n_loops == 0:
-            for p in interven_params:
-                p.adv_data = p.base_data.clone().detach()
+    if graphed:
+        cached = _get_graphed_step(model, config, interven_params, hyperparams, clip_at)
+        unlearner = cached.unlearner
+        clip_at = cached.clip_at
+    else:
+        unlearner = SurgicalUnlearner(
+            interven_params,
+            **hyperparams,
+            use_masking=config.use_masking,
+            normalize_grads=config.normalize_grads,
+        )
+    if not config.train_adversary:
+        unlearner.fork(copy=False)
 
+    def loop_step(r_input_ids, f_input_ids):
         # ! retain pass
         model.zero_grad(set_to_none=True)
-        for p in interven_params:  # switch to base model
-            p.data = p.base_data
-        output = model(r_input_ids)
-        loss = cross_entropy_loss(output, r_input_ids)
-        if config.additional_param_name == "rep_eng_retain_lr":
-            # ! representation engineering retain loss
-            rep_eng_loss = circuit_breaker_retain_loss(model, r_input_ids, frozen_model)
-            # note this loss is scaled both by this LR and retaining_rate
-            rep_eng_loss *= h.additional_param
-            loss += rep_eng_loss
-        loss.backward()
-        for p in interven_params:
-            assert p.data.data_ptr() == p.base_data.data_ptr()
-            # ! update disruption scores
-            p.retain_acc *= h.retain_momentum
-            p.retain_acc += p.grad * (1 - h.retain_momentum)
-            # ! retain update
-            p.base_data -= h.retaining_rate * p.retain_acc
-
-        if not config.train_adversary:
-            for p in interven_params:
-                p.adv_data = p.base_data
+        unlearner.use_base()
+        with phase("retain_pass"):
+            with autocast(cache_enabled=not graphed):
+                output = lm_forward(
+                    model, r_input_ids, output_hidden_states=use_rep_eng
+                )
+                loss = cross_entropy_loss(output, r_input_ids)
+            if use_rep_eng:
+                # ! representation engineering retain loss
+                orig_hidden = frozen_hidden_cache.get(r_input_ids, frozen_forward)
+                rep_eng_loss = rep_eng_retain_loss(
+                    output.hidden_states, orig_hidden, rep_eng_layers
+                )
+                # note this loss is scaled both by this LR and retaining_rate
+                rep_eng_loss *= h.additional_param
+                loss += rep_eng_loss
+            finite = backward(loss, interven_params)
+        if finite:
+            with phase("update"):
+                unlearner.retain_step()
 
         # ! relearn the adversary
         model.zero_grad(set_to_none=True)
-        for p in interven_params:  # switch to adversary
-            p.data = p.adv_data
-        output = model(f_input_ids)
-        if config.train_adversary:
-            loss = cross_entropy_loss(output, f_input_ids)
-            loss.backward(retain_graph=True)
-            for p in interven_params:
-                assert p.data.data_ptr() == p.adv_data.data_ptr()
-                # apply adversary update
-                p.adv_data -= h.adv_lr * p.grad
-                # decay adversary into base model
-                p.adv_data *= h.adv_decay
-                p.adv_data += p.base_data * (1 - h.adv_decay)
+        unlearner.use_adversary()
+        with phase("adversary_pass"):
+            with autocast(cache_enabled=not graphed):
+                output = lm_forward(model, f_input_ids)
+            if config.train_adversary:
+                with autocast(cache_enabled=not graphed):
+                    loss = cross_entropy_loss(output, f_input_ids)
+                finite = backward(loss, interven_params, retain_graph=True)
+        if config.train_adversary and finite:
+            with phase("update"):
+                unlearner.adversary_step()
 
         # ! unlearning step with masking
         # get unlearning grads loss from adversary
         # reuse the computation graph from previous block
         model.zero_grad(set_to_none=True)
         loss_fn = loss_fns[config.unlearning_loss_fn]
-        loss = loss_fn(output, f_input_ids, clip_at)
-        loss.backward()
-        grad_norm = sum(p.grad.norm() ** 2 for p in interven_params) ** 0.5
-        for p in interven_params:
-            assert p.data.data_ptr() == p.adv_data.data_ptr()
-
-            if config.additional_param_name == "forget_momentum":
-                p.forget_acc *= h.additional_param
-                p.forget_acc += p.grad * (1 - h.additional_param)
-                p.grad = p.forget_acc
+        with phase("unlearning_backward"):
+            with autocast(cache_enabled=not graphed):
+                loss = loss_fn(output, f_input_ids, clip_at)
+            finite = backward(loss, interven_params)
+        if finite:
+            with phase("update"):
+                unlearner.unlearning_step()
 
-            if config.use_masking:
-                mask = p.retain_acc.sign() == p.grad.sign()
-                p.grad *= mask
-
-            if config.additional_param_name == "discard_growing_weights":
-                mask2 = p.base_data.sign() != p.grad.sign()
-                p.grad[mask2] *= h.additional_param
+    # ! unlearning loop
+    logging.info("step      base_f      base_r")
+    retain_iter = iter(retain_batches)
+    forget_iter = iter(forget_batches)
 
-            # normalize
-            if config.normalize_grads:
-                p.grad *= total_interven_numel**0.5 / grad_norm
+    # ! unlearning loop
+    # rep_eng_retain_lr reuses the retain pass, and the frozen model's pass is memoized
+    passes_per_loop = 4 + int(config.train_adversary)
+    _eval_counter = 0
+    assert config.unlearn_steps % passes_per_loop == 0
+    for loop_num in range(config.unlearn_steps // passes_per_loop):
+        model.train()
+        with phase("data"):
+            f_input_ids = next(forget_iter)
+            r_input_ids = next(retain_iter)
+        count_tokens(f_input_ids)
+        count_tokens(r_input_ids)
 
-            # in Llama no optuna run, just turn off this line when retain perf broken
-            p.base_data -= h.unlearning_rate * p.grad
+        # without training, the adversary is just the base model
+        if config.train_adversary and loop_num % h.fork_every_n_loops == 0:
+            unlearner.fork()
 
-            if config.additional_param_name == "adv_update":
-                assert config.train_adversary  # otherwise it may be wrong
-                p.adv_data -= h.unlearning_rate * p.grad * h.additional_param
+        if graphed:
+            with phase("graphed_step"):
+                _graphed_loop_step(cached, loop_step, r_input_ids, f_input_ids)
+        else:
+            loop_step(r_input_ids, f_input_ids)
 
         # ! eval current loss
         _passes_done = (loop_num + 1) * passes_per_loop
         if _passes_done // 30 > _eval_counter:
             _eval_counter += 1
-            for p in interven_params:  # switch to base model
-                p.data = p.base_data
-            eval_(model, f_eval, r_eval, allowed_r_loss, _passes_done)
+            unlearner.use_base()
+            eval_(model, f_eval, r_eval, allowed_r_loss, _passes_done, trial)
 
+    if graphed:
+        # the grads live in the graph's memory pool, so don't let anything else use them
+        model.zero_grad(set_to_none=True)
     return model
+
+
+def _get_graphed_step(model, config, interven_params, hyperparams, clip_at):
+    """The cached graph and its buffers, reset for this trial, or new ones."""
+    key = (
+        tuple(config.target_modules),
+        config.unlearning_loss_fn,
+        config.use_masking,
+        config.normalize_grads,
+        config.train_adversary,
+        config.additional_param_name,
+        get_precision(),
+        # the graph reads and writes these exact tensors
+        tuple(t.data_ptr() for t in [*model.parameters(), *model.buffers()]),
+    )
+    cached = _graphed_steps.get(config.model_id)
+    if cached is not None and cached.key == key:
+        cached.unlearner.reset(**hyperparams)
+        cached.clip_at.fill_(clip_at)
+        return cached
+
+    # hyperparams are device scalars, so that the next trials only need to fill them
+    unlearner = SurgicalUnlearner(
+        interven_params,
+        **{name: pt.tensor(float(value)) for name, value in hyperparams.items()},
+        use_masking=config.use_masking,
+        normalize_grads=config.normalize_grads,
+        fixed_storage=True,
+    )
+    cached = SimpleNamespace(
+        key=key,
+        unlearner=unlearner,
+        clip_at=pt.tensor(float(clip_at)),
+        # in fp16-amp, skipping overflowed steps needs a sync, which can't be captured
+        capturable=pt.get_default_device().type == "cuda"
+        and get_precision() != "fp16-amp",
+        eager_loops=0,
+        graph=None,
+        r_input_ids=None,
+        f_input_ids=None,
+    )
+    _graphed_steps[config.model_id] = cached
+    return cached
+
+
+def _graphed_loop_step(cached, loop_step, r_input_ids, f_input_ids):
+    """Replays the captured loop step, capturing it after a few eager warmup loops."""
+    if cached.graph is not None and r_input_ids.shape == cached.r_input_ids.shape:
+        cached.r_input_ids.copy_(r_input_ids)
+        cached.f_input_ids.copy_(f_input_ids)
+        cached.graph.replay()
+        return
+
+    if not cached.capturable:
+        loop_step(r_input_ids, f_input_ids)
+        return
+
+    if cached.eager_loops < _warmup_loops:
+        # warmup on a side stream, as capturing requires
+        stream = pt.cuda.Stream()
+        stream.wait_stream(pt.cuda.current_stream())
+        with pt.cuda.stream(stream):
+            loop_step(r_input_ids, f_input_ids)
+        pt.cuda.current_stream().wait_stream(stream)
+        cached.eager_loops += 1
+        return
+
+    cached.r_input_ids = r_input_ids.clone()
+    cached.f_input_ids = f_input_ids.clone()
+    graph = pt.cuda.CUDAGraph()
+    try:
+        with pt.cuda.graph(graph):
+            loop_step(cached.r_input_ids, cached.f_input_ids)
+    except RuntimeError as e:
+        # nothing was run during the failed capture, so just run it eagerly
+        logging.warning(f"Capturing the loop step failed, running it eagerly: {e}")
+        cached.capturable = False
+        loop_step(r_input_ids, f_input_ids)
+        return
+    cached.graph = graph
+    # capturing only records the kernels
+    graph.replay()
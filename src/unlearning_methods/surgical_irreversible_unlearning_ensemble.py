@@ -0,0 +1,194 @@
+import logging
+from types import SimpleNamespace
+
+import torch as pt
+from torch.func import functional_call, vmap
+
+from utils.loss_fns import *
+from utils.model_operations import get_base_model
+from utils.profiling import count_tokens, phase
+from utils.training import *
+
+
+def surgical_irreversible_unlearning_ensemble(
+    hs,
+    config,
+    retain_batches,
+    forget_batches,
+    f_eval,
+    r_eval,
+    allowed_r_loss,
+    trials=None,
+):
+    """
+    Runs surgical_irreversible_unlearning for several trials at once, on one model.
+
+    Each trial gets its own stacked copy of the intervened params, and the forward
+    passes are vmapped over these copies, so for small models the trials share
+    kernel launches instead of each using a small fraction of the GPU.
+
+    Returns a list with a dict of unlearned intervened params for each trial,
+    or None for trials that got pruned.
+    """
+    assert config.additional_param_name is None, "ensemble doesn't support it"
+    assert get_precision() != "fp16-amp", "ensemble doesn't support loss scaling"
+    num_trials = len(hs)
+    fork_every_n_loops = [int(h.fork_every_n_loops) for h in hs]
+
+    model = get_base_model(config.model_id)
+    model.config.use_cache = False
+    # the model's own params are never trained - the stacked copies are
+    model.requires_grad_(False)
+
+    # get params to intervene on
+    interven_params = {
+        name: p
+        for name, p in model.named_parameters()
+        if any(f"{m}.weight" in name for m in config.target_modules)
+    }
+    total_interven_numel = sum(p.numel() for p in interven_params.values())
+    assert all(p.ndim == 2 for p in interven_params.values())
+
+    def per_trial(hyperparam_name):
+        # shaped so that it broadcasts over the stacked params
+        return pt.tensor([getattr(h, hyperparam_name) for h in hs]).reshape(-1, 1, 1)
+
+    retaining_rate = per_trial("retaining_rate")
+    unlearning_rate = per_trial("unlearning_rate")
+    adv_lr = per_trial("adv_lr")
+    adv_decay = per_trial("adv_decay")
+    retain_momentum = per_trial("retain_momentum")
+
+    base_data = {
+        name: p.detach().expand(num_trials, *p.shape).clone()
+        for name, p in interven_params.items()
+    }
+    adv_data = {name: data.clone() for name, data in base_data.items()}
+    retain_acc = {name: pt.zeros_like(data) for name, data in base_data.items()}
+    pruned = [False] * num_trials
+    # so all of them can be cast - only after the stacked copies are made from them,
+    # so that these are in fp32, like the intervened params in the sequential version
+    cast_frozen_params(model, [])
+
+    def forward(params, input_ids):
+        # params holds only one trial's intervened params, the rest is taken from model
+        with autocast():
+            return functional_call(model, params, (input_ids,)).logits
+
+    batched_forward = vmap(forward, in_dims=(0, None), randomness="same")
+
+    def summed_loss(loss_fn, logits, input_ids, *args):
+        # trials are independent, so grads of the sum are the per-trial grads
+        with autocast():
+            return sum(
+                loss_fn(SimpleNamespace(logits=trial_logits), input_ids, *args)
+                for trial_logits in logits
+            )
+
+    def trainable(data):
+        # .data has its own version counter, so later in-place updates of data are
+        # seen by a retained graph, like when swapping p.data in the sequential version
+        return {name: d.data.requires_grad_(True) for name, d in data.items()}
+
+    # ! unlearning loop
+    logging.info("step      base_f      base_r")
+    retain_iter = iter(retain_batches)
+    forget_iter = iter(forget_batches)
+
+    passes_per_loop = 4 + int(config.train_adversary)
+    _eval_counter = 0
+    assert config.unlearn_steps % passes_per_loop == 0
+    for loop_num in range(config.unlearn_steps // passes_per_loop):
+        model.train()
+        with phase("data"):
+            f_input_ids = next(forget_iter)
+            r_input_ids = next(retain_iter)
+        count_tokens(f_input_ids)
+        count_tokens(r_input_ids)
+
+        to_fork = pt.tensor([loop_num % n == 0 for n in fork_every_n_loops])
+        if config.train_adversary and to_fork.any():
+            for name in interven_params:
+                adv_data[name][to_fork] = base_data[name][to_fork]
+
+        # ! retain pass
+        params = trainable(base_data)
+        with phase("retain_pass"):
+            logits = batched_forward(params, r_input_ids)
+            loss = summed_loss(cross_entropy_loss, logits, r_input_ids)
+            grads = pt.autograd.grad(loss, list(params.values()))
+        with phase("update"), pt.no_grad():
+            for name, grad in zip(params, grads):
+                # ! update disruption scores
+                retain_acc[name] *= retain_momentum
+                retain_acc[name] += grad * (1 - retain_momentum)
+                # ! retain update
+                base_data[name] -= retaining_rate * retain_acc[name]
+
+        if not config.train_adversary:
+            adv_data = base_data
+
+        # ! relearn the adversary
+        params = trainable(adv_data)
+        with phase("adversary_pass"):
+            logits = batched_forward(params, f_input_ids)
+            if config.train_adversary:
+                loss = summed_loss(cross_entropy_loss, logits, f_input_ids)
+                grads = pt.autograd.grad(loss, list(params.values()), retain_graph=True)
+        if config.train_adversary:
+            with phase("update"), pt.no_grad():
+                for name, grad in zip(params, grads):
+                    # apply adversary update
+                    adv_data[name] -= adv_lr * grad
+                    # decay adversary into base model
+                    adv_data[name] *= adv_decay
+                    adv_data[name] += base_data[name] * (1 - adv_decay)
+
+        # ! unlearning step with masking
+        # get unlearning grads loss from adversary
+        # reuse the computation graph from previous block
+        loss_fn = loss_fns[config.unlearning_loss_fn]
+        with phase("unlearning_backward"):
+            loss = summed_loss(loss_fn, logits, f_input_ids, 0)
+            grads = pt.autograd.grad(loss, list(params.values()))
+        with phase("update"), pt.no_grad():
+            grad_norm = sum(g.flatten(start_dim=1).norm(dim=1) ** 2 for g in grads)
+            grad_norm **= 0.5
+            for name, grad in zip(params, grads):
+                if config.use_masking:
+                    mask = retain_acc[name].sign() == grad.sign()
+                    grad *= mask
+
+                # normalize
+                if config.normalize_grads:
+                    grad *= total_interven_numel**0.5 / grad_norm.reshape(-1, 1, 1)
+
+                base_data[name] -= unlearning_rate * grad
+
+        # ! eval current loss
+        _passes_done = (loop_num + 1) * passes_per_loop
+        if _passes_done // 30 > _eval_counter:
+            _eval_counter += 1
+            orig_data = {name: p.data for name, p in interven_params.items()}
+            for trial_num in range(num_trials):
+                if pruned[trial_num]:
+                    continue
+                # temporarily swap in this trial's params
+                for name, p in interven_params.items():
+                    p.data = base_data[name][trial_num]
+                trial = None if trials is None else trials[trial_num]
+                try:
+                    eval_(model, f_eval, r_eval, allowed_r_loss, _passes_done, trial)
+                except optuna.TrialPruned:
+                    pruned[trial_num] = True
+            for name, p in interven_params.items():
+                p.data = orig_data[name]
+            if all(pruned):
+                break
+
+    return [
+        None
+        if pruned[trial_num]
+        else {name: data[trial_num].clone() for name, data in base_data.items()}
+        for trial_num in range(num_trials)
+    ]
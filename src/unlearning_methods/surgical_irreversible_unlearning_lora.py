@@ -2,9 +2,9 @@ import logging
 
 import torch as pt
 from peft import LoraConfig, get_peft_config, get_peft_model
-from transformers import AutoModelForCausalLM
 
 from utils.loss_fns import *
+from utils.model_operations import get_base_model
 from utils.training import *
 
 
@@ -16,7 +16,14 @@ def only_grad_on(model, params):
 
 
 def surgical_irreversible_unlearning_lora(
-    h, config, retain_batches, forget_batches, f_eval, r_eval, allowed_r_loss
+    h,
+    config,
+    retain_batches,
+    forget_batches,
+    f_eval,
+    r_eval,
+    allowed_r_loss,
+    trial=None,
 ):
     assert config.use_masking
     assert config.normalize_grads
@@ -25,7 +32,8 @@ def surgical_irreversible_unlearning_lora(
 
     h.fork_every_n_loops = (int(h.fork_every_n_loops) // 6) * 6  # round to nearest 6
 
-    model = AutoModelForCausalLM.from_pretrained(config.model_id)
+    # peft modifies the model in place, so it needs its own copy
+    model = get_base_model(config.model_id, reuse=False)
     model.config.use_cache = False
     # get params to intervene on (must be before lora creation)
     interven_params = [
@@ -115,7 +123,7 @@ def surgical_irreversible_unlearning_lora(
         if _passes_done // 30 > _eval_counter:
             _eval_counter += 1
             with peft_model.disable_adapter():
-                eval_(model, f_eval, r_eval, allowed_r_loss, _passes_done)
+                eval_(model, f_eval, r_eval, allowed_r_loss, _passes_done, trial)
 
     # ! remove lora
     for lora_index in range(config.lora_amount):
@@ -1,14 +1,22 @@
 import logging
 
 import torch as pt
-from transformers import AutoModelForCausalLM
 
 from utils.loss_fns import *
+from utils.model_operations import get_base_model
+from utils.profiling import count_tokens, phase
 from utils.training import *
 
 
 def tar(
-    h, config, retain_batches, forget_batches, f_eval, r_eval, allowed_r_loss
+    h,
+    config,
+    retain_batches,
+    forget_batches,
+    f_eval,
+    r_eval,
+    allowed_r_loss,
+    trial=None,
 ):
     assert config.use_masking
     assert config.use_normalization
@@ -17,10 +25,8 @@ def tar(
 
     h.fork_every_n_loops = int(h.fork_every_n_loops)
 
-    model = AutoModelForCausalLM.from_pretrained(config.model_id)
-    adversary = AutoModelForCausalLM.from_pretrained(config.model_id)
+    model = get_base_model(config.model_id)
     model.config.use_cache = False
-    adversary.config.use_cache = False
 
     # get params to intervene on
     interven_params = [
@@ -28,17 +34,17 @@ def tar(
         for name, p in model.named_parameters()
         if any(f"{m}.weight" in name for m in config.target_modules)
     ]
-    adv_interven_params = [
-        p
-        for name, p in adversary.named_parameters()
-        if any(f"{m}.weight" in name for m in config.target_modules)
-    ]
 
     # require grads only on intervened params
     for p in model.parameters():
         p.requires_grad = id(p) in [id(p) for p in interven_params]
-    for p in adversary.parameters():
-        p.requires_grad = id(p) in [id(p) for p in adv_interven_params]
+    # intervened params stay in fp32, whatever the precision
+    cast_frozen_params(model, interven_params)
+
+    # the adversary differs from the base model only in the intervened params,
+    # so instead of a second model, they get swapped between base and adversary data
+    for p in interven_params:
+        p.base_data = p.data
 
     # ! unlearning loop
     logging.info("step      base_f      base_r")
@@ -51,53 +57,77 @@ def tar(
     assert config.unlearn_steps % passes_per_loop == 0
     for loop_num in range(config.unlearn_steps // passes_per_loop):
         model.train()
-        adversary.train()
-        
+
         # todo repE retain loss
 
         # ! retain pass
         model.zero_grad(set_to_none=True)
-        r_input_ids = next(retain_iter)
-        output = model(r_input_ids)
-        loss = cross_entropy_loss(output, r_input_ids)
-        loss.backward()
-        for p in interven_params:
-            # ! retain update
-            p.data -= h.retaining_rate * p.grad
+        for p in interven_params:  # switch to base model
+            p.data = p.base_data
+        with phase("data"):
+            r_input_ids = next(retain_iter)
+        count_tokens(r_input_ids)
+        with phase("retain_pass"):
+            with autocast():
+                output = lm_forward(model, r_input_ids)
+                loss = cross_entropy_loss(output, r_input_ids)
+            finite = backward(loss, interven_params)
+        if finite:
+            with phase("update"):
+                for p in interven_params:
+                    # ! retain update
+                    p.base_data -= h.retaining_rate * p.grad
         model.zero_grad(set_to_none=True)
 
         if (loop_num % h.fork_every_n_loops == 0) or (not config.train_adversary):
             # if not training adversary, make sure it's always the same as base model
-            adversary.load_state_dict(model.state_dict())
+            for p in interven_params:
+                p.adv_data = p.base_data.clone().detach()
 
         # for _ in range(adv_per_orig_step):
         # ! relearn the adversary
-        adversary.zero_grad(set_to_none=True)
-        f_input_ids = next(forget_iter)
-        output = adversary(f_input_ids)
-        loss = cross_entropy_loss(output, f_input_ids)
-        loss.backward(retain_graph=True)
-        for p, adv_p in zip(interven_params, adv_interven_params):
-            # apply adversary update
-            adv_p.data -= h.adv_lr * adv_p.grad
+        model.zero_grad(set_to_none=True)
+        for p in interven_params:  # switch to adversary
+            p.data = p.adv_data
+        with phase("data"):
+            f_input_ids = next(forget_iter)
+        count_tokens(f_input_ids)
+        with phase("adversary_pass"):
+            with autocast():
+                output = lm_forward(model, f_input_ids)
+                loss = cross_entropy_loss(output, f_input_ids)
+            finite = backward(loss, interven_params, retain_graph=True)
+        if finite:
+            with phase("update"):
+                for p in interven_params:
+                    # apply adversary update
+                    p.adv_data -= h.adv_lr * p.grad
 
         # ! get unlearning grads loss from adversary
         # reuse the computation graph from previous block
-        adversary.zero_grad(set_to_none=True)
-        loss = neg_entropy_loss(output, f_input_ids)
-        loss.backward()
+        model.zero_grad(set_to_none=True)
+        with phase("unlearning_backward"):
+            with autocast():
+                loss = neg_entropy_loss(output, f_input_ids)
+            finite = backward(loss, interven_params)
 
         # ! unlearning step
-        for p, adv_p in zip(interven_params, adv_interven_params):
-            update = adv_p.grad
-            update *= config.update_scale_factor
+        if finite:
+            with phase("update"):
+                for p in interven_params:
+                    update = p.grad
+                    update *= config.update_scale_factor
 
-            p.data -= h.unlearning_rate * update
+                    p.base_data -= h.unlearning_rate * update
 
         # ! eval current loss
         _passes_done = (loop_num + 1) * passes_per_loop
         if _passes_done // 30 > _eval_counter:
             _eval_counter += 1
-            eval_(model, f_eval, r_eval, allowed_r_loss, _passes_done)
+            for p in interven_params:  # switch to base model
+                p.data = p.base_data
+            eval_(model, f_eval, r_eval, allowed_r_loss, _passes_done, trial)
 
+    for p in interven_params:
+        p.data = p.base_data
     return model
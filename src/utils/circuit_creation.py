@@ -1,11 +1,17 @@
+import json
 import logging
+import math
+import os
 
 import torch as pt
+from safetensors import safe_open
+from safetensors.torch import save_file
 from tqdm import tqdm
 from transformers import AutoModelForCausalLM
 
 from utils.git_and_reproducibility import repo_root
 from utils.loss_fns import loss_fns
+from utils.training import autocast, get_precision
 
 
 def filter_and_normalize_circuit(circuit, target_modules):
@@ -32,60 +38,329 @@ def _get_circuit_dir(config):
     return circuit_dir
 
 
-def get_circuit(config, batches, circuit_name):
-    circuit_path = _get_circuit_dir(config) / f"{circuit_name}.pt"
+class DenseAccumulator:
+    """Sums outer products of input-side and output-side factors into a full matrix."""
+
+    def __init__(self, weight):
+        self.acc = pt.zeros_like(weight)
+
+    def add(self, in_, out):
+        self.acc += pt.einsum("...i,...o->oi", in_.float(), out.float())
+
+    def state(self):
+        return dict(acc=self.acc)
+
+    def result(self):
+        return self.acc
+
+
+class ChunkedAccumulator(DenseAccumulator):
+    """Like DenseAccumulator, but adds in chunks of rows, without a full temporary."""
+
+    def __init__(self, weight, chunk_size):
+        super().__init__(weight)
+        self.chunk_size = chunk_size
+
+    def add(self, in_, out):
+        # under autocast, factors may be in lower precision
+        in_ = in_.flatten(end_dim=-2).float()
+        out = out.flatten(end_dim=-2).float()
+        for start in range(0, out.shape[1], self.chunk_size):
+            end = start + self.chunk_size
+            self.acc[start:end].addmm_(out[:, start:end].T, in_)
+
+
+class SketchAccumulator:
+    """
+    Streaming low-rank sketch of the summed matrix A, as in Tropp et al. 2017,
+    "Practical sketching algorithms for low-rank matrix approximation".
+
+    Only A @ omega and psi @ A are kept, and at the end A is approximated with rank
+    `rank`. The sketches are linear in A, so they can be checkpointed and summed
+    across processes just like dense accumulators.
+    """
+
+    def __init__(self, weight, rank):
+        out_dim, in_dim = weight.shape
+        # fixed seed, so that it's the same in all processes and after resuming
+        # (the generator is on CPU, so they're generated there, whatever the default)
+        gen = pt.Generator().manual_seed(0)
+        omega = pt.randn(in_dim, rank, generator=gen, device="cpu")
+        psi = pt.randn(2 * rank + 1, out_dim, generator=gen, device="cpu")
+        self.omega = omega.to(weight)
+        self.psi = psi.to(weight)
+        self.y = weight.new_zeros(out_dim, rank)
+        self.w = weight.new_zeros(2 * rank + 1, in_dim)
+
+    def add(self, in_, out):
+        # under autocast, factors may be in lower precision
+        in_ = in_.flatten(end_dim=-2).float()
+        out = out.flatten(end_dim=-2).float()
+        # A += out.T @ in_
+        self.y.addmm_(out.T, in_ @ self.omega)
+        self.w.addmm_(self.psi @ out.T, in_)
+
+    def state(self):
+        return dict(y=self.y, w=self.w)
+
+    def result(self):
+        q, _ = pt.linalg.qr(self.y)
+        x = pt.linalg.lstsq(self.psi @ q, self.w).solution
+        return q @ x
+
+
+def _get_accumulator(config, weight):
+    match getattr(config, "circuit_accumulator", "dense"):
+        case "dense":
+            return DenseAccumulator(weight)
+        case "chunked":
+            chunk_size = getattr(config, "circuit_chunk_size", 1024)
+            return ChunkedAccumulator(weight, chunk_size)
+        case "sketch":
+            rank = getattr(config, "circuit_sketch_rank", 64)
+            return SketchAccumulator(weight, rank)
+        case _:
+            raise ValueError(f"unknown accumulator {config.circuit_accumulator}")
+
+
+def _accumulator_states(accumulators):
+    return {
+        f"{name}.{key}": tensor
+        for name, acc in accumulators.items()
+        for key, tensor in acc.state().items()
+    }
+
+
+def _get_rank():
+    if pt.distributed.is_available() and pt.distributed.is_initialized():
+        return pt.distributed.get_rank(), pt.distributed.get_world_size()
+    return 0, 1
+
+
+def _accumulate(config, batches, step_fn, accumulators, partial_path=None):
+    """
+    Runs step_fn on config.circuit_num_steps batches. step_fn must add its
+    contribution to the accumulators (a dict of tensors) in place.
+
+    If config.circuit_micro_batch_size is set, batches are split into micro-batches.
+    step_fn then gets each micro-batch together with the fraction of the batch it
+    makes up, and must scale its contribution with it, so that the result is the
+    same as without splitting.
+
+    If partial_path is given, accumulators are saved there every
+    config.circuit_checkpoint_every steps, and an interrupted build resumes from it.
+
+    If torch.distributed is initialized, each process accumulates every
+    world_size-th batch, and at the end the accumulators are summed.
+    """
+    # without loss scaling, fp16 grads of single tokens would underflow
+    assert get_precision() != "fp16-amp", "circuits can't be built in fp16-amp"
+    num_steps = config.circuit_num_steps
+    micro_batch_size = getattr(config, "circuit_micro_batch_size", None)
+    checkpoint_every = getattr(config, "circuit_checkpoint_every", 100)
+    rank, world_size = _get_rank()
+
+    start_step = 0
+    if partial_path is not None and partial_path.exists():
+        partial = pt.load(partial_path, weights_only=True)
+        start_step = partial["step"]
+        for name, acc in accumulators.items():
+            acc.copy_(partial["accumulators"][name])
+        logging.info(f"resuming from {partial_path.name} at step {start_step}")
+
+    batch_iter = iter(batches)
+    # skip batches already accumulated, so that the batch order stays the same
+    for _ in range(start_step):
+        next(batch_iter)
+
+    for step in tqdm(range(start_step, num_steps), initial=start_step, total=num_steps):
+        input_ids = next(batch_iter)
+        if step % world_size == rank:
+            if micro_batch_size is None:
+                step_fn(input_ids, 1)
+            else:
+                for micro_batch in input_ids.split(micro_batch_size):
+                    step_fn(micro_batch, len(micro_batch) / len(input_ids))
+
+        if partial_path is not None and (step + 1) % checkpoint_every == 0:
+            tmp_path = partial_path.with_suffix(".tmp")
+            pt.save(dict(step=step + 1, accumulators=accumulators), tmp_path)
+            os.replace(tmp_path, partial_path)
+
+    if world_size > 1:
+        for acc in accumulators.values():
+            pt.distributed.all_reduce(acc, op=pt.distributed.ReduceOp.SUM)
+
+
+def get_circuit(config, batches, circuit_name, target_modules=None):
+    """
+    Loads the circuit, or creates and saves it. With target_modules, only the
+    tensors of these modules are read from disk and returned.
+    """
+    circuit_dir = _get_circuit_dir(config)
+    file_name = circuit_name
+    if getattr(config, "circuit_accumulator", "dense") == "sketch":
+        # it's only approximate, so keep it apart from the exact ones
+        file_name += f",sketch{getattr(config, 'circuit_sketch_rank', 64)}"
+    # compact storage is lossy too, so it also gets its own file
+    storage = getattr(config, "circuit_storage", "dense")
+    topk_frac = getattr(config, "circuit_topk_frac", 0.01)
+    match storage:
+        case "dense":
+            pass
+        case "topk":
+            file_name += f",top{topk_frac}"
+        case "int8":
+            file_name += ",int8"
+        case _:
+            raise ValueError(f"unknown circuit storage {storage}")
+
+    circuit_path = circuit_dir / f"{file_name}.safetensors"
     if circuit_path.exists():
-        return pt.load(circuit_path, weights_only=True)
+        return _load_circuit(circuit_path, target_modules)
+    # circuits saved before switching to safetensors
+    legacy_path = circuit_dir / f"{file_name}.pt"
+    if legacy_path.exists() and storage == "dense":
+        circuit = pt.load(legacy_path, weights_only=True)
+        return _filter_circuit(circuit, target_modules)
     logging.info(f"circuit {circuit_name} not found, creating")
 
+    rank, world_size = _get_rank()
+    _suffix = f".rank{rank}" if world_size > 1 else ""
+    partial_path = circuit_dir / f"{file_name}.partial{_suffix}.pt"
+
     circuit_type, info = circuit_name.split(",", 1)
     match circuit_type:
         case "normal":
             loss_fn_name = info
-            circuit = get_normal_circuit(config, batches, loss_fn_name)
+            circuit = get_normal_circuit(config, batches, loss_fn_name, partial_path)
         case "k_dampens_grad":
-            circuit = get_circuit_k_dampens_grad(config, batches)
+            circuit = get_circuit_k_dampens_grad(config, batches, partial_path)
         case "k_dampens_grad_mlp_local":
-            circuit = get_circuit_k_dampens_grad_mlp_local(config, batches)
+            circuit = get_circuit_k_dampens_grad_mlp_local(
+                config, batches, partial_path
+            )
         case "k_dampens_grad_neuron_local":
-            circuit = get_circuit_k_dampens_grad_neuron_local(config, batches)
+            circuit = get_circuit_k_dampens_grad_neuron_local(
+                config, batches, partial_path
+            )
         case "fading_backprop":
             loss_fn_name, scale = info.split(",")
             scale = float(scale)
             circuit = get_circuit_with_fading_backprop(
-                config, batches, loss_fn_name, scale
+                config, batches, loss_fn_name, scale, partial_path
             )
         case "grad_misalign":
-            circuit = get_grad_misaligning(config, batches, info)
+            circuit = get_grad_misaligning(config, batches, info, partial_path)
         case _:
             raise ValueError(f"unknown circuit type {circuit_type}")
 
-    # save circuit
-    pt.save(circuit, circuit_path)
+    # save circuit, as safetensors so that single params can be loaded lazily
+    tensors, metadata = _compact_circuit(circuit, storage, topk_frac)
+    if rank == 0:
+        save_file(tensors, circuit_path, metadata=metadata)
+    partial_path.unlink(missing_ok=True)
+    # return the same as later loads will
+    return _expand_circuit(tensors.get, tensors.keys(), metadata, target_modules)
+
+
+def _filter_circuit(circuit, target_modules):
+    if target_modules is None:
+        return circuit
+    return {
+        name: param
+        for name, param in circuit.items()
+        if any(f"{m}.weight" in name for m in target_modules)
+    }
+
+
+def _compact_circuit(circuit, storage, topk_frac):
+    """
+    Tensors to save for the circuit: dense, or only its top-k entries by magnitude
+    (per tensor), or quantized to int8 with a scale per row. For the compact ones,
+    the dense shapes go to the metadata.
+    """
+    tensors = {}
+    for name, param in circuit.items():
+        match storage:
+            case "dense":
+                tensors[name] = param.contiguous()
+            case "topk":
+                flat = param.flatten()
+                k = max(1, math.ceil(topk_frac * len(flat)))
+                indices = flat.abs().topk(k).indices
+                tensors[f"{name}.indices"] = indices
+                tensors[f"{name}.values"] = flat[indices].contiguous()
+            case "int8":
+                rows = param.reshape(len(param), -1) if param.ndim > 1 else param[None]
+                scale = rows.abs().amax(dim=1, keepdim=True) / 127
+                scale = pt.where(scale > 0, scale, 1.0)
+                tensors[f"{name}.int8"] = (rows / scale).round().to(pt.int8)
+                tensors[f"{name}.scale"] = scale.contiguous()
+    metadata = dict(storage=storage)
+    if storage != "dense":
+        metadata["shapes"] = json.dumps({n: list(p.shape) for n, p in circuit.items()})
+    return tensors, metadata
+
+
+def _expand_circuit(get_tensor, names, metadata, target_modules=None):
+    """Inverse of _compact_circuit, getting only the tensors of target_modules."""
+    storage = (metadata or {}).get("storage", "dense")
+    if storage == "dense":
+        shapes = {name: None for name in names}
+    else:
+        shapes = json.loads(metadata["shapes"])
+
+    circuit = {}
+    for name, shape in _filter_circuit(shapes, target_modules).items():
+        match storage:
+            case "dense":
+                circuit[name] = get_tensor(name)
+            case "topk":
+                values = get_tensor(f"{name}.values")
+                dense = values.new_zeros(math.prod(shape))
+                dense[get_tensor(f"{name}.indices")] = values
+                circuit[name] = dense.reshape(shape)
+            case "int8":
+                rows = get_tensor(f"{name}.int8").float()
+                rows *= get_tensor(f"{name}.scale")
+                circuit[name] = rows.reshape(shape)
     return circuit
 
 
-def get_normal_circuit(config, batches, loss_fn_name):
+def _load_circuit(circuit_path, target_modules=None):
+    # safetensors memory-maps the file, so only the requested tensors get read
+    device = str(pt.get_default_device())
+    with safe_open(circuit_path, framework="pt", device=device) as f:
+        return _expand_circuit(f.get_tensor, f.keys(), f.metadata(), target_modules)
+
+
+def _zero_grads(model):
+    # backward adds into existing grads in place, so they can be used as accumulators
+    for param in model.parameters():
+        param.grad = pt.zeros_like(param)
+    return {name: param.grad for name, param in model.named_parameters()}
+
+
+def get_normal_circuit(config, batches, loss_fn_name, partial_path=None):
     model = AutoModelForCausalLM.from_pretrained(config.model_id)
     loss_fn = loss_fns[loss_fn_name]
 
-    # accumulate grads
-    model.zero_grad(set_to_none=True)
-    batch_iter = iter(batches)
-    for _ in tqdm(range(config.circuit_num_steps)):
-        input_ids = next(batch_iter)
-        output = model(input_ids, output_hidden_states=True)
-        loss = loss_fn(output, input_ids)
-        loss.backward()
+    def step_fn(input_ids, batch_frac):
+        with autocast():
+            output = model(input_ids, output_hidden_states=True)
+            loss = loss_fn(output, input_ids)
+        (loss * batch_frac).backward()
 
-    return {
-        name: param.grad
-        for name, param in model.named_parameters()
-        if param.grad is not None
-    }
+    # accumulate grads
+    grads = _zero_grads(model)
+    _accumulate(config, batches, step_fn, grads, partial_path)
+    return grads
 
 
-def get_circuit_with_fading_backprop(config, batches, loss_fn_name, scale=0.9):
+def get_circuit_with_fading_backprop(
+    config, batches, loss_fn_name, scale=0.9, partial_path=None
+):
     model = AutoModelForCausalLM.from_pretrained(config.model_id)
     loss_fn = loss_fns[loss_fn_name]
 
@@ -97,17 +372,18 @@ def get_circuit_with_fading_backprop(config, batches, loss_fn_name, scale=0.9):
             # module._backward_hooks.clear()
             module.register_full_backward_hook(scale_grad)
 
+    def step_fn(input_ids, batch_frac):
+        with autocast():
+            loss = loss_fn(model(input_ids), input_ids)
+        (loss * batch_frac).backward()
+
     # accumulate grads
-    model.zero_grad(set_to_none=True)
-    batch_iter = iter(batches)
-    for _ in tqdm(range(config.circuit_num_steps)):
-        input_ids = next(batch_iter)
-        loss = loss_fn(model(input_ids), input_ids)
-        loss.backward()
-    return {name: param.grad for name, param in model.named_parameters()}
+    grads = _zero_grads(model)
+    _accumulate(config, batches, step_fn, grads, partial_path)
+    return grads
 
 
-def get_grad_misaligning(config, batches, info):
+def get_grad_misaligning(config, batches, info, partial_path=None):
     model = AutoModelForCausalLM.from_pretrained(config.model_id)
     loss_fn = loss_fns["cross_entropy"]
     # don't require grads for the model
@@ -126,8 +402,7 @@ def get_grad_misaligning(config, batches, info):
         # normalize by grad norm, so that we depend on it linearly, not quadratically
         grad_norm = pt.norm(grad_output[0], dim=-1, keepdim=True)
         alignment = alignment / (grad_norm + 1e-10)
-        misaligning = pt.einsum("bth,btr->rh", alignment, grad_output[0])
-        module.weight.misaligning += misaligning
+        module.weight.misaligning.add(alignment, grad_output[0])
 
     def save_input_activation_hook(module, args, output):
         module.input_activations = args[0]
@@ -135,24 +410,30 @@ def get_grad_misaligning(config, batches, info):
     for name, module in model.named_modules():
         if "mlp.dense_4h_to_h" in name:
             module.register_full_backward_hook(save_misaligning_grad)
-            module.weight.misaligning = pt.zeros_like(module.weight)
+            module.weight.misaligning = _get_accumulator(config, module.weight)
             module.register_forward_hook(save_input_activation_hook)
 
-    batch_iter = iter(batches)
-    for _ in tqdm(range(config.circuit_num_steps)):
-        input_ids = next(batch_iter)
-        loss = loss_fn(model(input_ids), input_ids)
-        loss.backward()
+    def step_fn(input_ids, batch_frac):
+        # with the scaled loss, per-token grads are the same as for the whole batch
+        with autocast():
+            loss = loss_fn(model(input_ids), input_ids)
+        (loss * batch_frac).backward()
 
-    return {
+    misaligning = {
         name: param.misaligning
         for name, param in model.named_parameters()
         if hasattr(param, "misaligning")
     }
+    _accumulate(
+        config, batches, step_fn, _accumulator_states(misaligning), partial_path
+    )
+    return {name: acc.result() for name, acc in misaligning.items()}
 
 
-def get_circuit_k_dampens_grad(config, batches):
+def get_circuit_k_dampens_grad(config, batches, partial_path=None):
     assert "pythia" in config.model_id, "only pythia supported"
+    # the ratio of layernorm grads is too noisy in lower precision
+    assert get_precision() == "fp32", "k_dampens_grad needs fp32"
 
     model = AutoModelForCausalLM.from_pretrained(config.model_id)
     loss_fn = loss_fns["cross_entropy"]
@@ -172,14 +453,14 @@ def get_circuit_k_dampens_grad(config, batches):
         l.post_attention_layernorm.register_full_backward_hook(save_grad)
         l.mlp.dense_h_to_4h._backward_hooks.clear()
         l.mlp.dense_h_to_4h.register_full_backward_hook(save_grad)
-        l.mlp.dense_h_to_4h.weight.circuit = pt.zeros_like(l.mlp.dense_h_to_4h.weight)
-
-    # accumulate
-    batch_iter = iter(batches)
-    for _ in tqdm(range(config.circuit_num_steps)):
-        input_ids = next(batch_iter)
-        loss = loss_fn(model(input_ids), input_ids)
-        loss.backward()
+        weight = l.mlp.dense_h_to_4h.weight
+        weight.circuit = _get_accumulator(config, weight)
+
+    def step_fn(input_ids, batch_frac):
+        # with the scaled loss, per-token grads are the same as for the whole batch
+        with autocast():
+            loss = loss_fn(model(input_ids), input_ids)
+        (loss * batch_frac).backward()
         for l in model.gpt_neox.layers:
             # calculate update
             ln = l.post_attention_layernorm
@@ -189,18 +470,20 @@ def get_circuit_k_dampens_grad(config, batches):
             out = l.mlp.dense_h_to_4h.grad_out
             # replace nan with 0
             in_ = in_.nan_to_num()
-            update = pt.einsum("bti,bto->oi", in_, out)
-            assert not pt.isnan(update).any()
-            l.mlp.dense_h_to_4h.weight.circuit += update
+            assert not pt.isnan(in_).any() and not pt.isnan(out).any()
+            l.mlp.dense_h_to_4h.weight.circuit.add(in_, out)
 
-    return {
+    # accumulate
+    circuit = {
         name: param.circuit
         for name, param in model.named_parameters()
         if "mlp.dense_h_to_4h.weight" in name
     }
+    _accumulate(config, batches, step_fn, _accumulator_states(circuit), partial_path)
+    return {name: acc.result() for name, acc in circuit.items()}
 
 
-def get_circuit_k_dampens_grad_mlp_local(config, batches):
+def get_circuit_k_dampens_grad_mlp_local(config, batches, partial_path=None):
     assert "pythia" in config.model_id, "only pythia supported"
 
     model = AutoModelForCausalLM.from_pretrained(config.model_id)
@@ -217,30 +500,32 @@ def get_circuit_k_dampens_grad_mlp_local(config, batches):
     for l in model.gpt_neox.layers:
         l.mlp.dense_h_to_4h._backward_hooks.clear()
         l.mlp.dense_h_to_4h.register_full_backward_hook(save_grad)
-        l.mlp.dense_h_to_4h.weight.circuit = pt.zeros_like(l.mlp.dense_h_to_4h.weight)
-
-    # accumulate
-    batch_iter = iter(batches)
-    for _ in tqdm(range(config.circuit_num_steps)):
-        input_ids = next(batch_iter)
-        loss = loss_fn(model(input_ids), input_ids)
-        loss.backward()
+        weight = l.mlp.dense_h_to_4h.weight
+        weight.circuit = _get_accumulator(config, weight)
+
+    def step_fn(input_ids, batch_frac):
+        # with the scaled loss, per-token grads are the same as for the whole batch
+        with autocast():
+            loss = loss_fn(model(input_ids), input_ids)
+        (loss * batch_frac).backward()
         for l in model.gpt_neox.layers:
             # calculate update
             in_ = l.mlp.dense_h_to_4h.grad_in
             out = l.mlp.dense_h_to_4h.grad_out
-            update = pt.einsum("bti,bto->oi", in_, out)
-            assert not pt.isnan(update).any()
-            l.mlp.dense_h_to_4h.weight.circuit += update
+            assert not pt.isnan(in_).any() and not pt.isnan(out).any()
+            l.mlp.dense_h_to_4h.weight.circuit.add(in_, out)
 
-    return {
+    # accumulate
+    circuit = {
         name: param.circuit
         for name, param in model.named_parameters()
         if "mlp.dense_h_to_4h.weight" in name
     }
+    _accumulate(config, batches, step_fn, _accumulator_states(circuit), partial_path)
+    return {name: acc.result() for name, acc in circuit.items()}
 
 
-def get_circuit_k_dampens_grad_neuron_local(config, batches):
+def get_circuit_k_dampens_grad_neuron_local(config, batches, partial_path=None):
     assert "pythia" in config.model_id, "only pythia supported"
 
     model = AutoModelForCausalLM.from_pretrained(config.model_id)
@@ -259,23 +544,26 @@ def get_circuit_k_dampens_grad_neuron_local(config, batches):
         l.mlp.dense_h_to_4h.register_full_backward_hook(save_grad)
         l.mlp.dense_h_to_4h.weight.circuit = pt.zeros_like(l.mlp.dense_h_to_4h.weight)
 
-    # accumulate
-    batch_iter = iter(batches)
-    for _ in tqdm(range(config.circuit_num_steps)):
-        input_ids = next(batch_iter)
-        loss = loss_fn(model(input_ids), input_ids)
-        loss.backward()
+    def step_fn(input_ids, batch_frac):
+        # with the scaled loss, per-token grads are the same as for the whole batch
+        with autocast():
+            loss = loss_fn(model(input_ids), input_ids)
+        (loss * batch_frac).backward()
         for l in model.gpt_neox.layers:
             # calculate update
             out = l.mlp.dense_h_to_4h.grad_out
-            out_avg = out.mean(dim=0).mean(dim=0).reshape(-1, 1)
+            # average over the whole batch, not just this micro-batch
+            out_avg = out.mean(dim=0).mean(dim=0).reshape(-1, 1) * batch_frac
             weights = l.mlp.dense_h_to_4h.weight.data
             assert out_avg.shape[0] == weights.shape[0]
             update = weights * out_avg
             l.mlp.dense_h_to_4h.weight.circuit += update
 
-    return {
+    # accumulate
+    circuit = {
         name: param.circuit
         for name, param in model.named_parameters()
         if "mlp.dense_h_to_4h.weight" in name
     }
+    _accumulate(config, batches, step_fn, circuit, partial_path)
+    return circuit
@@ -1,8 +1,26 @@
+import hashlib
+import itertools
 import json
+import logging
+import os
+import queue
 import re
+import threading
+from pathlib import Path
 
+import numpy as np
 import torch as pt
-from datasets import IterableDataset, IterableDatasetDict, load_dataset
+from datasets import (
+    Dataset,
+    DatasetDict,
+    IterableDataset,
+    IterableDatasetDict,
+    load_dataset,
+)
+
+from utils.git_and_reproducibility import repo_root
+
+context_len = 100
 
 
 def looping_iter(iterable):
@@ -15,23 +33,90 @@ def get_batch(iter, n):
     return pt.cat([next(iter)["input_ids"] for _ in range(n)])
 
 
-def prepare_dataset(raw_dataset, tokenizer, preprocess_fn=lambda ex: {}):
+def _pack(dataset, eos_token_id):
+    # concatenate the documents, separated by EOS, and cut them into context_len rows
+    # (the trailing incomplete row is dropped)
+    def packed_rows():
+        buffer = []
+        for ex in dataset:
+            buffer.extend(ex["input_ids"])
+            buffer.append(eos_token_id)
+            while len(buffer) >= context_len:
+                yield {"input_ids": pt.tensor([buffer[:context_len]])}
+                buffer = buffer[context_len:]
+
+    return IterableDataset.from_generator(packed_rows)
+
+
+def _tokenize_rows(batch, tokenizer, preprocess_fn, pack):
+    # batched version of preprocessing and tokenization, returning context_len rows
+    examples = [dict(zip(batch, values)) for values in zip(*batch.values())]
+    texts = [(ex | preprocess_fn(ex))["text"] for ex in examples]
+    if not pack:
+        ids = tokenizer(texts, max_length=context_len, truncation=True)["input_ids"]
+        return {"input_ids": [row for row in ids if len(row) == context_len]}
+
+    # like _pack, but only within this batch of examples
+    flat = []
+    for row in tokenizer(texts)["input_ids"]:
+        flat.extend(row)
+        flat.append(tokenizer.eos_token_id)
+    num_rows = len(flat) // context_len
+    return {
+        "input_ids": [
+            flat[i * context_len : (i + 1) * context_len] for i in range(num_rows)
+        ]
+    }
+
+
+def prepare_dataset(
+    raw_dataset, tokenizer, preprocess_fn=lambda ex: {}, pack=False, num_proc=None
+):
     # preprocess_fn is used to add additional fields to the dataset before tokenization
-    context_len = 100
+    # with pack=True, short examples aren't discarded, but packed together into rows
+    # with num_proc, splits are instead processed eagerly, with batched tokenization
+    # on num_proc processes, and a DatasetDict of context_len rows is returned
 
     # split into 4 quarters
     half1, half2 = raw_dataset.train_test_split(test_size=0.5, seed=42).values()
     quarter3, quarter4 = half2.train_test_split(test_size=0.5, seed=42).values()
 
-    dataset = (
-        # define splits; make it iterable so that it can be processed on demand
-        IterableDatasetDict(
-            train=IterableDataset.from_generator(lambda: (ex for ex in half1)),
-            validation=IterableDataset.from_generator(lambda: (ex for ex in quarter3)),
-            test=IterableDataset.from_generator(lambda: (ex for ex in quarter4)),
-        ).map(preprocess_fn)
+    if num_proc is not None:
+        dataset = DatasetDict(train=half1, validation=quarter3, test=quarter4).map(
+            _tokenize_rows,
+            fn_kwargs=dict(tokenizer=tokenizer, preprocess_fn=preprocess_fn, pack=pack),
+            batched=True,
+            batch_size=1000,
+            num_proc=num_proc,
+            remove_columns=raw_dataset.column_names,
+        )
+        assert dataset["test"][0]["input_ids"] != dataset["train"][0]["input_ids"]
+        return dataset
+
+    # define splits; make it iterable so that it can be processed on demand
+    dataset = IterableDatasetDict(
+        train=IterableDataset.from_generator(lambda: (ex for ex in half1)),
+        validation=IterableDataset.from_generator(lambda: (ex for ex in quarter3)),
+        test=IterableDataset.from_generator(lambda: (ex for ex in quarter4)),
+    ).map(preprocess_fn)
+    dataset = _tokenize(dataset, tokenizer, pack)
+
+    test_row = next(iter(dataset["test"]))["input_ids"]
+    assert not pt.equal(test_row, next(iter(dataset["train"]))["input_ids"])
+    return dataset
+
+
+def _tokenize(dataset, tokenizer, pack):
+    if pack:
+        # tokenize whole examples, and pack them into rows of exactly 100 tokens
+        dataset = dataset.map(lambda ex: tokenizer(ex["text"]))
+        return IterableDatasetDict(
+            {split: _pack(d, tokenizer.eos_token_id) for split, d in dataset.items()}
+        )
+
+    return (
         # tokenize
-        .map(
+        dataset.map(
             lambda ex: tokenizer(
                 ex["text"],
                 return_tensors="pt",
@@ -43,59 +128,128 @@ def prepare_dataset(raw_dataset, tokenizer, preprocess_fn=lambda ex: {}):
         # this together with truncation ensures that each example has exactly 100 tokens
         .filter(lambda ex: ex["input_ids"].shape[-1] >= context_len)
     )
-    assert next(iter(dataset["test"]))["text"] != next(iter(dataset["train"]))["text"]
+
+
+def _hash_split(text):
+    # stable across runs and processes, unlike hash()
+    digest = hashlib.blake2b(text.encode(), digest_size=8).digest()
+    quarter = int.from_bytes(digest, "little") % 4
+    # same proportions as the halves and quarters in prepare_dataset
+    return ["train", "train", "validation", "test"][quarter]
+
+
+def prepare_streaming_dataset(
+    raw_stream,
+    tokenizer,
+    preprocess_fn=lambda ex: {},
+    pack=False,
+    max_rows=None,
+    num_proc=None,
+):
+    """
+    Like prepare_dataset, but for a streamed IterableDataset, which is never loaded
+    whole. Each example goes to a split by a hash of its text, so there's no shuffling,
+    and with max_rows the stream is read only until each split has that many rows.
+    """
+    # num_proc is ignored, because here tokenization happens lazily, while streaming
+    stream = raw_stream.map(preprocess_fn)
+    dataset = IterableDatasetDict(
+        {
+            split: stream.filter(lambda ex, s=split: _hash_split(ex["text"]) == s)
+            for split in ["train", "validation", "test"]
+        }
+    )
+    dataset = _tokenize(dataset, tokenizer, pack)
+    if max_rows is not None:
+        dataset = IterableDatasetDict(
+            {split: d.take(max_rows) for split, d in dataset.items()}
+        )
     return dataset
 
 
-def load_one_oscar_shard(lang, tokenizer):
-    # only use one ~600MB shard
-    # also, streaming would make splitting too slow
-    return prepare_dataset(
+def load_oscar(lang, tokenizer, shards=(1,), max_rows=100_000, **kwargs):
+    # streamed and split by hash, so only as much is downloaded as is needed
+    # OSCAR_DIR can point to a local copy, with the same layout as on the hub
+    oscar_dir = os.environ.get("OSCAR_DIR", "hf://datasets/oscar-corpus/OSCAR-2301")
+    return prepare_streaming_dataset(
         load_dataset(
             "text",
             split="train",  # train is the only split in oscar
-            data_files=f"hf://datasets/oscar-corpus/OSCAR-2301/{lang}_meta/{lang}_meta_part_1.jsonl.zst",
+            data_files=[
+                f"{oscar_dir}/{lang}_meta/{lang}_meta_part_{shard}.jsonl.zst"
+                for shard in shards
+            ],
+            streaming=True,
         ),
         tokenizer,
         # process the raw data, following OSCAR-2301.py
         lambda ex: {"text": json.loads(ex["text"])["content"]},
+        max_rows=max_rows,
+        **kwargs,
     )
 
 
-def load_wikitext(tokenizer):
+def load_wikitext(tokenizer, **kwargs):
     return prepare_dataset(
         # train split is big enough so just use it - it's simpler
         load_dataset("Salesforce/wikitext", "wikitext-103-raw-v1", split="train"),
         tokenizer,
+        **kwargs,
     )
 
 
-def load_cruelty(tokenizer):
+def load_cruelty(tokenizer, **kwargs):
     beavertails = load_dataset("PKU-Alignment/BeaverTails")
     split = beavertails["330k_train"]
     category = "animal_abuse"
     # from 300k examples filters down to 3k
     beaver_category = split.filter(lambda ex: ex["category"][category])
     # prepare dataset further filters out short examples, down to 1.5k, or 90 batches of 16
+    # (unless pack=True, which keeps all of them)
     return prepare_dataset(
         beaver_category,
         tokenizer,
         lambda ex: {"text": ex["response"]},
         # lambda ex: {"text": ex["prompt"] + "\n" + ex["response"]},
+        **kwargs,
     )
 
 
-def load_beaver_safe(tokenizer):
+def load_cruelty_streaming(tokenizer, **kwargs):
+    # like load_cruelty, but streamed, and with splits by hash
+    # (so the splits differ from load_cruelty's, and results aren't comparable)
+    beavertails = load_dataset("PKU-Alignment/BeaverTails", streaming=True)
+    split = beavertails["330k_train"]
+    beaver_category = split.filter(lambda ex: ex["category"]["animal_abuse"])
+    return prepare_streaming_dataset(
+        beaver_category, tokenizer, lambda ex: {"text": ex["response"]}, **kwargs
+    )
+
+
+def load_beaver_safe(tokenizer, **kwargs):
     beavertails = load_dataset("PKU-Alignment/BeaverTails")
     split = beavertails["330k_train"]
     # from 300k examples filters down to 134k
     safe_examples = split.filter(lambda ex: ex["is_safe"])
     # prepare dataset further filters out short examples, down to 40k examples
+    # (unless pack=True, which keeps all of them)
     return prepare_dataset(
         safe_examples,
         tokenizer,
         lambda ex: {"text": ex["response"]},
         # lambda ex: {"text": ex["prompt"] + "\n" + ex["response"]},
+        **kwargs,
+    )
+
+
+def load_beaver_safe_streaming(tokenizer, **kwargs):
+    # like load_beaver_safe, but streamed, and with splits by hash
+    # (so the splits differ from load_beaver_safe's, and results aren't comparable)
+    beavertails = load_dataset("PKU-Alignment/BeaverTails", streaming=True)
+    split = beavertails["330k_train"]
+    safe_examples = split.filter(lambda ex: ex["is_safe"])
+    return prepare_streaming_dataset(
+        safe_examples, tokenizer, lambda ex: {"text": ex["response"]}, **kwargs
     )
 
 
@@ -112,35 +266,234 @@ def _remove_comments_and_docstrings(code: str) -> str:
     return code
 
 
-def load_python_dataset(tokenizer):
+def load_python_dataset(tokenizer, **kwargs):
     return prepare_dataset(
         load_dataset("Nan-Do/code-search-net-python", split="train"),
         tokenizer,
         lambda ex: {"text": _remove_comments_and_docstrings(ex["code"])},
+        **kwargs,
     )
 
 
 dataset_loaders = dict(
     wikitext=load_wikitext,
     python=load_python_dataset,
-    oscar_en=lambda tokenizer: load_one_oscar_shard("en", tokenizer),
-    oscar_pl=lambda tokenizer: load_one_oscar_shard("pl", tokenizer),
-    # oscar_es=lambda tokenizer: load_one_oscar_shard("es", tokenizer),
+    oscar_en=lambda tokenizer, **kw: load_oscar("en", tokenizer, **kw),
+    oscar_pl=lambda tokenizer, **kw: load_oscar("pl", tokenizer, **kw),
+    # oscar_es=lambda tokenizer, **kw: load_oscar("es", tokenizer, **kw),
     cruelty=load_cruelty,
     beaver_safe=load_beaver_safe,
+    cruelty_streaming=load_cruelty_streaming,
+    beaver_safe_streaming=load_beaver_safe_streaming,
 )
 
 
+def _get_token_store_path(dataset_name, tokenizer, split, pack=False):
+    _tokenizer_name = tokenizer.name_or_path.replace("/", "_")
+    # e.g. TOKEN_STORE_DIR=/dev/shm/token_store keeps the stores in shared memory,
+    # so that all workers on a host map the same pages
+    root = Path(os.environ.get("TOKEN_STORE_DIR", repo_root() / "token_store"))
+    store_dir = root / dataset_name / _tokenizer_name
+    _packed = "_packed" if pack else ""
+    return store_dir / f"{context_len}{_packed}_{split}.npy"
+
+
+def build_token_store(dataset, path, vocab_size):
+    dtype = np.uint16 if vocab_size <= 2**16 else np.int32
+    if isinstance(dataset, Dataset):
+        # already tokenized in bulk, so just read the whole column at once
+        token_store = dataset.with_format("numpy")[:]["input_ids"].astype(dtype)
+    else:
+        # one pass over the split, storing the rows in their original order
+        rows = [pt.as_tensor(ex["input_ids"]).flatten().cpu().numpy() for ex in dataset]
+        token_store = np.stack(rows).astype(dtype)
+    assert token_store.shape[1] == context_len
+
+    # write to a temp file and rename, so that a half-written store is never loaded
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp_path, "wb") as f:
+        np.save(f, token_store)
+    os.replace(tmp_path, path)
+
+
+def get_token_store(dataset_name, tokenizer, split, pack=False):
+    """
+    Returns a memory-mapped (num_rows, context_len) array of tokens for the given split.
+    It is tokenized only once per (dataset, tokenizer, context_len, pack, split) and
+    then read from disk, so later processes skip the streaming and tokenization.
+    """
+    path = _get_token_store_path(dataset_name, tokenizer, split, pack)
+    if not path.exists():
+        logging.info(f"token store {path} not found, creating")
+        # tokenize in bulk, in parallel (streamed datasets are tokenized lazily)
+        dataset = dataset_loaders[dataset_name](
+            tokenizer, pack=pack, num_proc=os.cpu_count()
+        )
+        if isinstance(dataset, DatasetDict):
+            # all splits got tokenized anyway, so store them all
+            for _split, split_dataset in dataset.items():
+                _path = _get_token_store_path(dataset_name, tokenizer, _split, pack)
+                if not _path.exists():
+                    build_token_store(split_dataset, _path, len(tokenizer))
+        else:
+            build_token_store(dataset[split], path, len(tokenizer))
+    # copy-on-write mapping, so that torch gets a writable (but never written) view
+    return np.load(path, mmap_mode="c")
+
+
+# so that batch keys of different CachedBatches never collide, even after one is freed
+_batches_ids = itertools.count()
+
+
+def _with_key(batch, key):
+    # batches are replayed in the same order, so (source, index) identifies their
+    # content, and caches like ActivationCache can key on it without reading it
+    batch.batch_key = key
+    return batch
+
+
 class CachedBatches:
-    def __init__(self, base_iter, batch_size):
-        assert isinstance(base_iter, IterableDataset)
-        self.base_iter = looping_iter(base_iter)
+    def __init__(self, base_iter, batch_size, max_device_batches=None):
+        # base_iter is either a tokenized dataset, or a token store from get_token_store
+        # for a dataset, cached batches past the first max_device_batches are spilled
+        # to pinned host memory; a token store needs no cache, but its first
+        # max_device_batches are then kept on the device
+        assert isinstance(base_iter, (IterableDataset, np.ndarray))
         self.batch_size = batch_size
+        self.max_device_batches = max_device_batches
         self.cache = []
+        self.batches_id = next(_batches_ids)
+        if isinstance(base_iter, np.ndarray):
+            self.token_store = base_iter
+        else:
+            self.token_store = None
+            self.base_iter = looping_iter(base_iter)
 
     def __iter__(self):
-        yield from self.cache
+        if self.token_store is not None:
+            yield from self._iter_token_store()
+            return
+
+        device = pt.get_default_device()
+        for item in self.cache:
+            # spilled items are copied back on the fly
+            if item.is_pinned():
+                item = _with_key(item.to(device, non_blocking=True), item.batch_key)
+            yield item
         while True:
-            new_item = get_batch(self.base_iter, self.batch_size)
-            self.cache.append(new_item)
-            yield new_item
\ No newline at end of file
+            key = (self.batches_id, len(self.cache))
+            new_item = _with_key(get_batch(self.base_iter, self.batch_size), key)
+            self.cache.append(self._maybe_spill(new_item))
+            yield new_item
+
+    def _maybe_spill(self, item):
+        # each iteration starts from the first batch, so those are the ones to keep
+        if self.max_device_batches is None or len(self.cache) < self.max_device_batches:
+            return item
+        if item.device.type != "cuda":
+            return item
+        return _with_key(item.cpu().pin_memory(), item.batch_key)
+
+    def _iter_token_store(self):
+        # the store already holds all the batches, so by default nothing is cached on
+        # the device, only the first max_device_batches if set
+        # (the trailing incomplete batch is skipped)
+        num_batches = len(self.token_store) // self.batch_size
+        store_name = getattr(self.token_store, "filename", "token store")
+        assert num_batches > 0, (
+            f"{store_name} has only {len(self.token_store)} rows, "
+            f"fewer than batch_size={self.batch_size}"
+        )
+        device = pt.get_default_device()
+        while True:
+            for i in range(num_batches):
+                if i < len(self.cache):
+                    yield self.cache[i]
+                    continue
+                rows = self.token_store[i * self.batch_size : (i + 1) * self.batch_size]
+                batch = pt.from_numpy(rows)  # zero-copy view of the mmap
+                if device.type == "cuda":
+                    batch = batch.pin_memory().to(device, non_blocking=True)
+                batch = _with_key(batch.to(pt.int64), (self.batches_id, i))
+                if self.max_device_batches is not None and i < self.max_device_batches:
+                    self.cache.append(batch)
+                yield batch
+
+
+class PrefetchedBatches:
+    """
+    Wraps CachedBatches, keeping the next num_prefetch batches ready on the device.
+
+    Batches are produced by a background thread, in the same order as without it.
+    On cuda they're copied from pinned memory on a side stream, so neither the
+    tokenization on a cache miss nor the copy is on the critical path.
+    """
+
+    def __init__(self, batches, num_prefetch=2):
+        self.batches = batches
+        self.num_prefetch = num_prefetch
+        self._stop_previous = lambda: None
+
+    def __iter__(self):
+        # the underlying batches may only be iterated by one thread at a time
+        self._stop_previous()
+
+        # the default device is per thread, so the producer makes CPU tensors
+        device = pt.get_default_device()
+        stream = pt.cuda.Stream(device) if device.type == "cuda" else None
+        ready = queue.Queue(maxsize=self.num_prefetch)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    ready.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for batch in self.batches:
+                    event = None
+                    if stream is not None:
+                        with pt.cuda.stream(stream):
+                            if batch.device != device:
+                                key = batch.batch_key
+                                batch = batch.pin_memory()
+                                batch = batch.to(device, non_blocking=True)
+                                batch = _with_key(batch, key)
+                            event = pt.cuda.Event()
+                            event.record(stream)
+                    if not put((batch, event)):
+                        return
+            except Exception as e:
+                put((e, None))
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+
+        def stop_thread():
+            stop.set()
+            thread.join()
+
+        self._stop_previous = stop_thread
+        return self._consume(ready, stop_thread)
+
+    def _consume(self, ready, stop_thread):
+        try:
+            while True:
+                batch, event = ready.get()
+                if isinstance(batch, Exception):
+                    raise batch
+                if event is not None:
+                    current_stream = pt.cuda.current_stream()
+                    current_stream.wait_event(event)
+                    # so that its memory isn't reused while still used on this stream
+                    batch.record_stream(current_stream)
+                yield batch
+        finally:
+            # runs when the iterator is closed or garbage collected
+            stop_thread()
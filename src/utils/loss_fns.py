@@ -1,9 +1,117 @@
 import gc
+import os
+import shutil
+import tempfile
+import weakref
+from functools import cached_property, partial
 
+import numpy as np
 import torch as pt
 
+# --- Chunked LM head ---
+# if set, lm_forward skips the LM head, and losses compute logits in chunks of rows
+_lm_head_chunk_size = None
+
+
+def set_lm_head_chunk_size(chunk_size):
+    global _lm_head_chunk_size
+    _lm_head_chunk_size = chunk_size
+
+
+class HeadlessOutput:
+    """Model output without the LM head applied; logits are only computed if needed."""
+
+    def __init__(self, base_output, lm_head):
+        assert lm_head.bias is None
+        self.last_hidden_state = base_output.last_hidden_state
+        self.hidden_states = base_output.hidden_states
+        self.lm_head = lm_head
+
+    @cached_property
+    def logits(self):
+        # fallback for losses which need full logits
+        return self.lm_head(self.last_hidden_state)
+
+    def sum_over_rows(self, row_fn, targets, positions=slice(None, -1)):
+        # row_fn(logits, targets) must return a sum over the rows
+        hidden = self.last_hidden_state[:, positions, :].flatten(end_dim=1)
+        return _ChunkedRowSum.apply(
+            hidden, self.lm_head.weight, targets, row_fn, _lm_head_chunk_size
+        )
+
+
+def lm_forward(model, input_ids, **kwargs):
+    """Like model(input_ids), but with the LM head deferred, if chunking is set."""
+    if _lm_head_chunk_size is None:
+        return model(input_ids, **kwargs)
+    base_output = model.base_model(input_ids, **kwargs)
+    return HeadlessOutput(base_output, model.get_output_embeddings())
+
+
+class _ChunkedRowSum(pt.autograd.Function):
+    """
+    Sum of row_fn(hidden @ weight.T, targets) computed in chunks of rows, so that only
+    one chunk of logits exists at a time. Backward recomputes each chunk's logits.
+    """
+
+    @staticmethod
+    def forward(ctx, hidden, weight, targets, row_fn, chunk_size):
+        # under autocast the matmul runs in lower precision, so backward must match
+        device_type = hidden.device.type
+        if pt.is_autocast_enabled(device_type):
+            ctx.dtype = pt.get_autocast_dtype(device_type)
+        else:
+            ctx.dtype = pt.promote_types(hidden.dtype, weight.dtype)
+        ctx.row_fn = row_fn
+        ctx.chunk_size = chunk_size
+        ctx.save_for_backward(hidden, weight, targets)
+
+        total = pt.zeros((), dtype=pt.float32, device=hidden.device)
+        w = weight.to(ctx.dtype)
+        # backward recomputes without autocast, so it's off here too, and the matmul
+        # is cast explicitly; row_fn must upcast what needs fp32 itself
+        with pt.autocast(device_type, enabled=False):
+            for start in range(0, len(hidden), chunk_size):
+                chunk = slice(start, start + chunk_size)
+                logits = hidden[chunk].to(ctx.dtype) @ w.T
+                total += row_fn(logits, targets[chunk])
+        return total
+
+    @staticmethod
+    def backward(ctx, grad_total):
+        hidden, weight, targets = ctx.saved_tensors
+        need_hidden, need_weight = ctx.needs_input_grad[:2]
+        grad_hidden = pt.zeros_like(hidden) if need_hidden else None
+        grad_weight = pt.zeros_like(weight) if need_weight else None
+
+        with pt.enable_grad():
+            weight = weight.detach().requires_grad_(need_weight)
+            w = weight.to(ctx.dtype)
+            for start in range(0, len(hidden), ctx.chunk_size):
+                chunk = slice(start, start + ctx.chunk_size)
+                h = hidden[chunk].detach().requires_grad_(need_hidden)
+                loss = ctx.row_fn(h.to(ctx.dtype) @ w.T, targets[chunk])
+                inputs = [t for t in [h, weight] if t.requires_grad]
+                # the cast weight is shared between chunks, so retain its graph
+                grads = pt.autograd.grad(loss, inputs, grad_total, retain_graph=True)
+                grads = list(grads)
+                if need_hidden:
+                    grad_hidden[chunk] = grads.pop(0)
+                if need_weight:
+                    grad_weight += grads.pop(0)
+
+        return grad_hidden, grad_weight, None, None, None
+
+
+def _cross_entropy_rows(logits, ids):
+    return pt.nn.functional.cross_entropy(logits.float(), ids, reduction="sum")
+
 
 def cross_entropy_loss(output, input_ids, _dummy=None):
+    if isinstance(output, HeadlessOutput):
+        ids = input_ids[:, 1:].flatten()
+        return output.sum_over_rows(_cross_entropy_rows, ids) / len(ids)
+
     return pt.nn.CrossEntropyLoss()(
         output.logits[:, :-1, :].flatten(end_dim=1).to(pt.float32),
         input_ids[:, 1:].flatten(),
@@ -34,6 +142,12 @@ def neg_entropy_loss(output, input_ids, _dummy=None) -> pt.Tensor:
     Returns:
         pt.Tensor: The negative mean entropy loss.
     """
+    if isinstance(output, HeadlessOutput):
+        # all positions, like below
+        ids = input_ids.flatten()
+        entropy = output.sum_over_rows(_entropy_rows, ids, positions=slice(None))
+        return entropy / len(ids) * -1
+
     logits = output.logits
     softmax = pt.nn.functional.softmax(logits, dim=-1)
     log_softmax = pt.nn.functional.log_softmax(logits, dim=-1)
@@ -41,7 +155,30 @@ def neg_entropy_loss(output, input_ids, _dummy=None) -> pt.Tensor:
     return entropy.mean() * -1
 
 
+def _entropy_rows(logits, _ids):
+    # in fp32, like autocast runs softmax
+    logits = logits.to(pt.float32)
+    softmax = pt.nn.functional.softmax(logits, dim=-1)
+    log_softmax = pt.nn.functional.log_softmax(logits, dim=-1)
+    return pt.sum(-softmax * log_softmax)
+
+
+def _biased_entropy_rows(logits, ids, correct_logit_bias):
+    logits = logits.to(pt.float32)
+    # out of place, as logits are needed for backward
+    # (and backward runs in another thread, so devices are explicit)
+    correct = (pt.arange(len(ids), device=ids.device), ids)
+    bias = logits.new_tensor(correct_logit_bias)
+    logits = logits.index_put(correct, bias, accumulate=True)
+    return _entropy_rows(logits, ids)
+
+
 def biased_neg_entropy_loss(output, input_ids, correct_logit_bias) -> pt.Tensor:
+    if isinstance(output, HeadlessOutput):
+        ids = input_ids[:, 1:].flatten()
+        row_fn = partial(_biased_entropy_rows, correct_logit_bias=correct_logit_bias)
+        return output.sum_over_rows(row_fn, ids) / len(ids) * -1
+
     logits = output.logits[:, :-1, :].flatten(end_dim=1).to(pt.float32)
     ids = input_ids[:, 1:].flatten()
     # shift up the correct logits, so that they'll need to be brought further down
@@ -53,7 +190,19 @@ def biased_neg_entropy_loss(output, input_ids, correct_logit_bias) -> pt.Tensor:
     return entropy.mean() * -1
 
 
+def _correct_logit_minus_avg_rows(logits, ids, clip_at):
+    logits = logits.to(pt.float32)
+    rows = pt.arange(len(ids), device=ids.device)
+    true_logits = logits[rows, ids] - logits.mean(dim=-1)
+    return true_logits.clip(min=clip_at).sum()
+
+
 def correct_logit_minus_avg_loss(output, input_ids, clip_at):
+    if isinstance(output, HeadlessOutput):
+        ids = input_ids[:, 1:].flatten()
+        row_fn = partial(_correct_logit_minus_avg_rows, clip_at=clip_at)
+        return output.sum_over_rows(row_fn, ids) / len(ids)
+
     logits = output.logits[:, :-1, :].flatten(end_dim=1).to(pt.float32)
     ids = input_ids[:, 1:].flatten()
     true_logits = logits[pt.arange(len(ids)), ids]
@@ -77,7 +226,10 @@ def circuit_breaker_forget_loss(
     target_layers,
     frozen_model=None,
     LoRA=False,
+    frozen_hidden=None,
 ):
+    # frozen_hidden are the frozen model's stacked target_layers activations,
+    # e.g. from an ActivationCache - if given, frozen_model isn't needed
 
     forget_attention_mask = pt.ones_like(forget_input_ids)
 
@@ -92,23 +244,28 @@ def circuit_breaker_forget_loss(
         len(target_layers), 1, 1
     ).unsqueeze(-1)
 
-    if LoRA is True and frozen_model is None:
-        model.disable_adapter()
-        frozen_model = model
-
-    if LoRA is False and frozen_model is None:
-        raise Exception("Function did not get frozen model and LoRA is disabled.")
-
-    assert frozen_model is not None
-
-    frozen_model.eval()
-    with pt.no_grad():
-        forget_outputs = frozen_model(**forget_inputs).hidden_states
-        forget_hidden = pt.stack([forget_outputs[l].detach() for l in target_layers])
-    del forget_outputs
-    gc.collect()
-    if LoRA is True and frozen_model is None:
-        model.enable_adapters()
+    if frozen_hidden is not None:
+        forget_hidden = frozen_hidden
+    else:
+        if LoRA is True and frozen_model is None:
+            model.disable_adapter()
+            frozen_model = model
+
+        if LoRA is False and frozen_model is None:
+            raise Exception("Function did not get frozen model and LoRA is disabled.")
+
+        assert frozen_model is not None
+
+        frozen_model.eval()
+        with pt.no_grad():
+            forget_outputs = frozen_model(**forget_inputs).hidden_states
+            forget_hidden = pt.stack(
+                [forget_outputs[l].detach() for l in target_layers]
+            )
+        del forget_outputs
+        gc.collect()
+        if LoRA is True and frozen_model is None:
+            model.enable_adapters()
     model.train()
 
     lora_forget_outputs = model(**forget_inputs).hidden_states
@@ -130,7 +287,11 @@ def circuit_breaker_forget_loss(
     return forget_loss
 
 
-def circuit_breaker_retain_loss(model, retain_input_ids, frozen_model=None, LoRA=False):
+def circuit_breaker_retain_loss(
+    model, retain_input_ids, frozen_model=None, LoRA=False, frozen_hidden=None
+):
+    # frozen_hidden are the frozen model's stacked activations on all layers,
+    # e.g. from an ActivationCache - if given, frozen_model isn't needed
 
     retain_attention_mask = pt.ones_like(retain_input_ids)
 
@@ -140,29 +301,36 @@ def circuit_breaker_retain_loss(model, retain_input_ids, frozen_model=None, LoRA
         output_hidden_states=True,
     )
 
-    if LoRA is True:
-        model.disable_adapter_layers()
-        frozen_model = model
-
-    if LoRA is False and frozen_model is None:
-        raise Exception("Function did not get frozen model and LoRA is disabled.")
-
-    assert frozen_model is not None
-
-    frozen_model.eval()
-    with pt.no_grad():
-        orig_retain_outputs = frozen_model(**retain_inputs).hidden_states
-        orig_retain_hidden = pt.stack(orig_retain_outputs).detach()
+    if frozen_hidden is not None:
+        # the mask is all ones, so it's enough to shape it
+        orig_retain_hidden = frozen_hidden
         layers_retain_attention_mask = retain_attention_mask.repeat(
-            len(orig_retain_outputs), 1, 1
+            len(frozen_hidden), 1, 1
         ).unsqueeze(-1)
-        orig_retain_hidden *= layers_retain_attention_mask
-
-    del orig_retain_outputs
-    gc.collect()
-
-    if LoRA is True:
-        model.enable_adapter_layers()
+    else:
+        if LoRA is True:
+            model.disable_adapter_layers()
+            frozen_model = model
+
+        if LoRA is False and frozen_model is None:
+            raise Exception("Function did not get frozen model and LoRA is disabled.")
+
+        assert frozen_model is not None
+
+        frozen_model.eval()
+        with pt.no_grad():
+            orig_retain_outputs = frozen_model(**retain_inputs).hidden_states
+            orig_retain_hidden = pt.stack(orig_retain_outputs).detach()
+            layers_retain_attention_mask = retain_attention_mask.repeat(
+                len(orig_retain_outputs), 1, 1
+            ).unsqueeze(-1)
+            orig_retain_hidden *= layers_retain_attention_mask
+
+        del orig_retain_outputs
+        gc.collect()
+
+        if LoRA is True:
+            model.enable_adapter_layers()
     model.train()
 
     lora_retain_outputs = model(**retain_inputs).hidden_states
@@ -174,6 +342,121 @@ def circuit_breaker_retain_loss(model, retain_input_ids, frozen_model=None, LoRA
     return retain_loss
 
 
+def rep_eng_retain_loss(hidden_states, orig_hidden, layers=None):
+    # like circuit_breaker_retain_loss, but reusing an existing forward pass
+    # orig_hidden are the stacked frozen activations on layers (None for all)
+    if layers is not None:
+        hidden_states = [hidden_states[l] for l in layers]
+    hidden = pt.stack(hidden_states)
+    return pt.norm(hidden - orig_hidden, dim=-1, p=2, dtype=pt.float).nanmean()
+
+
+class ActivationCache:
+    """
+    Memoizes the frozen model's hidden states on each batch.
+
+    CachedBatches replays the same batches in every trial, and the frozen model
+    doesn't change, so its activations only need to be computed once per batch.
+    Batches are identified by their batch_key, set by CachedBatches, so that looking
+    them up doesn't need to read the batch back from the device.
+    """
+
+    def __init__(self, layers=None, dtype=None, storage="cpu", max_batches=None):
+        # layers=None keeps all the hidden states
+        self.layers = layers
+        # e.g. pt.float16, to halve the memory; they're cast back when returned
+        self.dtype = dtype
+        # "cpu" (pinned host memory), "device", or "memmap" (files in a temp dir)
+        assert storage in ["cpu", "device", "memmap"], f"unknown {storage=}"
+        self.storage = storage
+        # batches past the first max_batches aren't cached; every trial replays them
+        # from the first one, so unlike LRU, this keeps the ones which get reused
+        self.max_batches = max_batches
+        self.cache = {}
+        if storage == "memmap":
+            self.dir = tempfile.mkdtemp(prefix="activation_cache_")
+            weakref.finalize(self, shutil.rmtree, self.dir, ignore_errors=True)
+
+    def get(self, input_ids, frozen_forward):
+        key = getattr(input_ids, "batch_key", None)
+        if key is None:
+            # not from CachedBatches, so key by content, which syncs with the device
+            key = input_ids.cpu().numpy().tobytes()
+
+        if key not in self.cache:
+            with pt.no_grad():
+                hidden_states = frozen_forward(input_ids)
+            layers = range(len(hidden_states)) if self.layers is None else self.layers
+            hidden = pt.stack([hidden_states[l] for l in layers]).detach()
+            if self.max_batches is not None and len(self.cache) >= self.max_batches:
+                return hidden
+            self.cache[key] = self._store(hidden)
+
+        return self._load(self.cache[key], input_ids.device)
+
+    def _store(self, hidden):
+        orig_dtype = hidden.dtype
+        if self.dtype is not None:
+            hidden = hidden.to(self.dtype)
+        match self.storage:
+            case "device":
+                pass
+            case "cpu":
+                hidden = hidden.cpu()
+                if pt.cuda.is_available():
+                    hidden = hidden.pin_memory()
+            case "memmap":
+                # as raw bytes, as numpy has no bfloat16
+                raw = hidden.cpu().contiguous().view(pt.uint8)
+                path = os.path.join(self.dir, f"{len(self.cache)}.bin")
+                array = np.memmap(path, dtype=np.uint8, mode="w+", shape=raw.shape)
+                array[:] = raw.numpy()
+                array.flush()
+                return array, hidden.dtype, orig_dtype
+        return hidden, hidden.dtype, orig_dtype
+
+    def _load(self, entry, device):
+        hidden, stored_dtype, orig_dtype = entry
+        if self.storage == "memmap":
+            hidden = pt.from_numpy(hidden).view(stored_dtype)
+        return hidden.to(device, non_blocking=True).to(orig_dtype)
+
+
+# kept across the trials of a study, so that all of them share them
+_activation_caches = {}
+
+
+def clear_activation_caches():
+    """
+    Drops all the cached activations. Batch keys are only unique within one set of
+    CachedBatches, so this needs to be called whenever new ones are loaded, e.g. for
+    each study, or the caches would stay full of entries which never get hit again.
+    """
+    _activation_caches.clear()
+
+
+def get_activation_cache(config, layers=None):
+    """
+    Returns the shared cache of base model activations on the given layers.
+    Storage is controlled by activation_cache_dtype, activation_cache_storage
+    and activation_cache_max_batches.
+    """
+    dtype = getattr(config, "activation_cache_dtype", None)
+    storage = getattr(config, "activation_cache_storage", "cpu")
+    max_batches = getattr(config, "activation_cache_max_batches", 64)
+    key = (
+        config.model_id,
+        None if layers is None else tuple(layers),
+        dtype,
+        storage,
+        max_batches,
+    )
+    if key not in _activation_caches:
+        dtype = None if dtype is None else getattr(pt, dtype)
+        _activation_caches[key] = ActivationCache(layers, dtype, storage, max_batches)
+    return _activation_caches[key]
+
+
 # def correct_logit_loss(output, input_ids):
 #     logits = output.logits[:, :-1, :].flatten(end_dim=1).to(pt.float32)
 #     ids = input_ids[:, 1:].flatten()
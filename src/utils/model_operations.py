@@ -1,12 +1,18 @@
 import logging
+import os
 from copy import deepcopy
+from pathlib import Path
 
+import optuna
 import torch as pt
 import wandb
 from peft import LoraConfig, get_peft_model
+from transformers import AutoModelForCausalLM
 
+from utils.git_and_reproducibility import repo_root
 from utils.loss_fns import *
-from utils.training import eval_
+from utils.profiling import count_tokens, phase
+from utils.training import autocast, backward, eval_, get_precision
 
 
 def only_grad_on(model, params_to_grad):
@@ -16,13 +22,168 @@ def only_grad_on(model, params_to_grad):
         param.requires_grad = True
 
 
-def get_thresh(quantile, disruption_scores):
+def _get_model_store_dir(model_id):
+    # e.g. MODEL_STORE_DIR=/dev/shm/model_store, like TOKEN_STORE_DIR
+    root = os.environ.get("MODEL_STORE_DIR")
+    root = Path(root) if root else repo_root() / "model_store"
+    return root / model_id.replace("/", "_")
+
+
+def save_model_store(model_id):
+    """
+    Saves the base model as safetensors, once per host. get_base_model then loads
+    it from there memory-mapped, so the worker processes on a host all map the same
+    file, which is read from disk once, instead of each downloading the model or
+    unpickling a .bin checkpoint.
+    """
+    model_dir = _get_model_store_dir(model_id)
+    if model_dir.exists():
+        return
+    model = AutoModelForCausalLM.from_pretrained(model_id)
+    # save to a temp dir and rename, so that a half-written store is never loaded
+    tmp_dir = model_dir.with_name(f"{model_dir.name}.{os.getpid()}.tmp")
+    model.save_pretrained(tmp_dir, safe_serialization=True)
+    os.replace(tmp_dir, model_dir)
+
+
+# per-process cache of base models:
+# model_id -> (model, pristine_state, param_storage, param_attrs)
+_base_models = {}
+
+
+def get_base_model(model_id, reuse=True):
+    """
+    Returns the base model in its original state, reading it from disk only once.
+
+    With reuse=True the same module is handed out on every call, with its weights
+    restored in place from a device-resident copy of the original state. All the
+    params are restored, as writes through p.data leave no trace on the param, so
+    there's no telling which ones were modified, and relearning trains them all.
+    It's a device-side copy, much cheaper than loading.
+    With reuse=False an independent copy is returned, which is needed when the
+    model will be modified structurally, e.g. by peft.
+    """
+    if model_id not in _base_models:
+        model_dir = _get_model_store_dir(model_id)
+        # the model store is saved by the worker-pool mode of study_runner
+        model = AutoModelForCausalLM.from_pretrained(
+            model_dir if model_dir.exists() else model_id
+        )
+        # clone tied tensors only once, so that the pristine state keeps the tying
+        clones = {}
+        pristine_state = {
+            name: clones.setdefault(tensor.data_ptr(), tensor.detach().clone())
+            for name, tensor in model.state_dict().items()
+        }
+        # the params' own tensors, which they're restored into, so that their
+        # storage stays the same across trials
+        param_storage = {name: p.data for name, p in model.named_parameters()}
+        param_attrs = {name: set(p.__dict__) for name, p in model.named_parameters()}
+        _base_models[model_id] = (model, pristine_state, param_storage, param_attrs)
+    else:
+        model, pristine_state, param_storage, param_attrs = _base_models[model_id]
+        _restore_base_model(model, pristine_state, param_storage, param_attrs)
+
+    return model if reuse else deepcopy(model)
+
+
+def _restore_base_model(model, pristine_state, param_storage, param_attrs):
+    for name, p in model.named_parameters():
+        storage = param_storage[name]
+        if p.data_ptr() != storage.data_ptr() or p.dtype != storage.dtype:
+            # p.data was swapped for another tensor, or cast by cast_frozen_params
+            p.data = storage
+        storage.copy_(pristine_state[name])
+        p.requires_grad = True
+        p.grad = None
+        # drop attributes attached during the trial, like retain_acc or base_data
+        for attr in set(p.__dict__) - param_attrs[name]:
+            delattr(p, attr)
+
+
+def get_base_hidden_states(model, model_id, input_ids):
+    """Hidden states of the original base model, computed by swapping in its weights."""
+    _, pristine_state, _, _ = _base_models[model_id]
+    was_training = model.training
+    model.eval()
+    with pt.no_grad():
+        output = pt.func.functional_call(
+            model, pristine_state, (input_ids,), dict(output_hidden_states=True)
+        )
+    model.train(was_training)
+    return output.hidden_states
+
+
+def get_thresh(
+    quantile, disruption_scores, num_passes=4, prev_thresh=None, margin=0.05
+):
     """
     Calculate threshold value for parameter masking, based on the quantile.
     For example, if quantile is 0.01, the threshould will cut off 1% of the highest scores.
+
+    Gives the same value as pt.quantile(..., 1 - quantile, interpolation="lower") on
+    all the scores concatenated, but without concatenating or sorting them: it's
+    a radix select, in num_passes passes over the scores, each fixing 8 bits.
+    With fewer than 4 passes it's approximate, the returned value being at most
+    the exact one, and (for normal floats) within a relative 2 ** (9 - 8 * num_passes)
+    of it.
+
+    When the scores changed only slightly since prev_thresh was computed, pass it,
+    and if the threshold is still within margin of it (relative), it's found
+    exactly in one pass, from only the scores in that range.
     """
-    flat_scores = pt.cat([s.flatten() for s in disruption_scores])
-    return pt.quantile(flat_scores, 1 - quantile, interpolation="lower")
+    n = sum(s.numel() for s in disruption_scores)
+    # the same rank as pt.quantile picks, which computes it in the scores' dtype
+    k = int((pt.tensor(1 - quantile, dtype=pt.float32) * (n - 1)).floor())
+    device = disruption_scores[0].device
+
+    if prev_thresh is not None:
+        lo = prev_thresh - margin * abs(prev_thresh)
+        hi = prev_thresh + margin * abs(prev_thresh)
+        num_below = sum(int((s < lo).sum()) for s in disruption_scores)
+        near = [s[(s >= lo) & (s <= hi)] for s in disruption_scores]
+        num_near = sum(len(s) for s in near)
+        if num_below <= k < num_below + num_near:
+            # sorted, as kthvalue has no deterministic CUDA implementation
+            near = pt.cat(near).float().sort().values
+            return near[k - num_below]
+
+    # bits of the threshold's key fixed so far, as an unsigned int
+    prefix = 0
+    for pass_num in range(num_passes):
+        shift = 24 - 8 * pass_num
+        # the same bits as an int32, as the keys are
+        signed_prefix = prefix - 2**32 if prefix >= 2**31 else prefix
+        hist = 0
+        for s in disruption_scores:
+            keys = _sortable_keys(s)
+            digits = (keys >> shift) & 255
+            if pass_num > 0:
+                # scores not matching the bits fixed so far go to the extra bin
+                matching = (keys >> (shift + 8)) == (signed_prefix >> (shift + 8))
+                digits = pt.where(matching, digits, 256)
+            hist += pt.bincount(digits, minlength=257)
+        counts = hist[:256].cumsum(dim=0)
+        digit = int(pt.searchsorted(counts, k, right=True))
+        if digit > 0:
+            k -= int(counts[digit - 1])
+        prefix |= digit << shift
+
+    return _sortable_key_to_float(prefix).to(device)
+
+
+def _sortable_keys(scores):
+    """Bits of float scores as int32 keys, which sort like the floats when unsigned."""
+    bits = scores.float().flatten().view(pt.int32)
+    # negative floats sort in reverse of their bits, so flip all of them,
+    # and for the positive ones flip just the sign bit, to put them after
+    return bits ^ ((bits >> 31) | -(2**31))
+
+
+def _sortable_key_to_float(key):
+    # the inverse of _sortable_keys, for a key given as an unsigned int
+    bits = key - 2**31 if key >= 2**31 else (key ^ 0xFFFFFFFF) - 2**32
+    return pt.tensor(bits, dtype=pt.int32).view(pt.float32)
 
 
 def copy_model_and_collapse_loras(peft_model, delete_adv=True):
@@ -40,7 +201,16 @@ def copy_model_and_collapse_loras(peft_model, delete_adv=True):
     return collapsed
 
 
-def relearn(model, config, retain_val_batches, forget_val_batches, use_lora=False):
+def relearn(
+    model,
+    config,
+    retain_val_batches,
+    forget_val_batches,
+    use_lora=False,
+    trial=None,
+    step_offset=0,
+):
+    # step_offset places the relearning reports after the unlearning ones
     for p in model.parameters():
         p.requires_grad = True
 
@@ -51,10 +221,16 @@ def relearn(model, config, retain_val_batches, forget_val_batches, use_lora=Fals
     r_eval_batch = next(retain_val_iter)
 
     if use_lora:
+        # peft modifies the model in place, and it may be the reused base model
+        model = deepcopy(model)
         lora_config = LoraConfig(**config.relearn_lora_conf)
         peft_model = get_peft_model(model, lora_config, adapter_name="relearning_lora")
         model = peft_model.model
 
+    if get_precision() == "bf16":
+        # all params are trained now, so they need fp32 master copies
+        model.float()
+
     optimizer = pt.optim.SGD(model.parameters(), lr=config.relearn_lr)
 
     # ! relearning loop
@@ -66,15 +242,26 @@ def relearn(model, config, retain_val_batches, forget_val_batches, use_lora=Fals
         # standard forward, backward, and update
         model.train()
         optimizer.zero_grad(set_to_none=True)
-        f_input_ids = next(forget_val_iter)
-        loss_forget = cross_entropy_loss(model(f_input_ids), f_input_ids)
-        loss_forget.backward()
-        optimizer.step()
+        with phase("data"):
+            f_input_ids = next(forget_val_iter)
+        count_tokens(f_input_ids)
+        with phase("relearn"):
+            with autocast():
+                output = lm_forward(model, f_input_ids)
+                loss_forget = cross_entropy_loss(output, f_input_ids)
+            if backward(loss_forget, model.parameters()):
+                optimizer.step()
 
         _passes_done = (loop_num + 1) * passes_per_loop
         if _passes_done % 30 == 0:
             res = eval_(model, f_eval_batch, r_eval_batch, step=_passes_done)
             f_losses.append(res["forget_loss"])
+            if trial is not None:
+                # report what the objective will be, so far
+                trial.report(min(f_losses).item(), step_offset + _passes_done)
+                if trial.should_prune():
+                    logging.info(f"Pruning trial because the pruner decided so")
+                    raise optuna.TrialPruned()
             # wandb.log(res, step=_passes_done)
 
     logging.info("")
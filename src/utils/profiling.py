@@ -0,0 +1,146 @@
+import contextlib
+import logging
+import time
+from collections import defaultdict
+
+import torch as pt
+
+from utils.git_and_reproducibility import repo_root
+
+# per-process stats of the current trial, reset by start_trial
+_cpu_times = defaultdict(float)
+_cuda_events = defaultdict(list)
+_num_tokens = 0
+# None when no trial is recorded, so that phases cost nothing then
+_trial_start = None
+
+
+def _on_cuda():
+    return pt.get_default_device().type == "cuda"
+
+
+@contextlib.contextmanager
+def phase(name):
+    """
+    Adds the time spent in the block to the phase's total for the current trial.
+    On GPU it's timed with CUDA events, so it doesn't synchronize.
+    Nested phases count in both.
+    """
+    if _trial_start is None:
+        yield
+    elif not _on_cuda():
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            _cpu_times[name] += time.perf_counter() - start
+    elif pt.cuda.is_current_stream_capturing():
+        # events can't be recorded into a CUDA graph; its replays get timed instead
+        yield
+    else:
+        start = pt.cuda.Event(enable_timing=True)
+        end = pt.cuda.Event(enable_timing=True)
+        start.record()
+        try:
+            yield
+        finally:
+            end.record()
+            _cuda_events[name].append((start, end))
+
+
+def count_tokens(input_ids):
+    global _num_tokens
+    _num_tokens += input_ids.numel()
+
+
+def start_trial():
+    global _num_tokens, _trial_start
+    _cpu_times.clear()
+    _cuda_events.clear()
+    _num_tokens = 0
+    if _on_cuda():
+        pt.cuda.synchronize()
+        pt.cuda.reset_peak_memory_stats()
+    _trial_start = time.perf_counter()
+
+
+def stop_trial():
+    """Ends recording the current trial, returning its stats."""
+    global _trial_start
+    trial_start, _trial_start = _trial_start, None
+    if _on_cuda():
+        pt.cuda.synchronize()
+    total_time = time.perf_counter() - trial_start
+
+    times = dict(_cpu_times)
+    for name, events in _cuda_events.items():
+        seconds = sum(start.elapsed_time(end) for start, end in events) / 1000
+        times[name] = times.get(name, 0) + seconds
+    stats = dict(times=times, total_time=total_time, num_tokens=_num_tokens)
+    if _on_cuda():
+        stats["peak_memory_gb"] = pt.cuda.max_memory_allocated() / 2**30
+    return stats
+
+
+def add_stats(stats, other):
+    """Stats of both parts, e.g. a shared ensemble run and a trial's relearning."""
+    times = dict(stats["times"])
+    for name, seconds in other["times"].items():
+        times[name] = times.get(name, 0) + seconds
+    added = dict(
+        times=times,
+        total_time=stats["total_time"] + other["total_time"],
+        num_tokens=stats["num_tokens"] + other["num_tokens"],
+    )
+    if "peak_memory_gb" in stats:
+        added["peak_memory_gb"] = max(stats["peak_memory_gb"], other["peak_memory_gb"])
+    return added
+
+
+def set_trial_stats(trial, stats):
+    """Stores per-phase totals, tokens/sec and peak memory as trial user attrs."""
+    for name, seconds in stats["times"].items():
+        trial.set_user_attr(f"time_{name}", seconds)
+    trial.set_user_attr("time_total", stats["total_time"])
+    trial.set_user_attr("tokens_per_sec", stats["num_tokens"] / stats["total_time"])
+    if "peak_memory_gb" in stats:
+        trial.set_user_attr("peak_memory_gb", stats["peak_memory_gb"])
+
+
+def record_trial(trial, shared_stats=None):
+    """
+    Ends recording the trial and stores its stats, plus shared_stats if given.
+    Recording is best-effort: it logs instead of raising, as it runs in a finally
+    and could hide the trial's own error, e.g. after a CUDA error.
+    """
+    try:
+        stats = stop_trial()
+        if shared_stats is not None:
+            stats = add_stats(shared_stats, stats)
+        set_trial_stats(trial, stats)
+    except Exception as e:
+        logging.warning(f"Couldn't record stats of trial {trial.number}: {e}")
+
+
+@contextlib.contextmanager
+def maybe_profile(config, trial):
+    """With `profile_trial: N` in the config, saves a torch.profiler trace of it."""
+    if trial.number != getattr(config, "profile_trial", None):
+        yield
+        return
+
+    activities = [pt.profiler.ProfilerActivity.CPU]
+    if _on_cuda():
+        activities.append(pt.profiler.ProfilerActivity.CUDA)
+    profiler = pt.profiler.profile(activities=activities, profile_memory=True)
+    try:
+        with profiler:
+            yield
+    finally:
+        # save it also when the trial got pruned
+        folder = repo_root() / "profiles"
+        folder.mkdir(parents=True, exist_ok=True)
+        file_name = f"{trial.study.study_name}|trial{trial.number}".replace("/", "_")
+        path = folder / f"{file_name}.json"
+        profiler.export_chrome_trace(str(path))
+        logging.info(f"Saved profiler trace to {path}")
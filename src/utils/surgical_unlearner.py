@@ -0,0 +1,206 @@
+import torch as pt
+
+
+def _add_scaled_(tensors, others, scale):
+    """tensors += others * scale, where scale is a float or a device scalar."""
+    if isinstance(scale, pt.Tensor):
+        pt._foreach_add_(tensors, pt._foreach_mul(others, scale))
+    else:
+        pt._foreach_add_(tensors, others, alpha=scale)
+
+
+class SurgicalUnlearner(pt.optim.Optimizer):
+    """
+    The updates of surgical_irreversible_unlearning, as an optimizer.
+
+    Each param has a base version and an adversary version, and the model is switched
+    between them with use_base and use_adversary. All the updates are done with
+    multi-tensor _foreach_ ops, so their cost doesn't grow with the number of params.
+
+    Hyperparams can be floats, or device scalars which can be changed with
+    set_hyperparams without reallocating anything. With fixed_storage=True the params
+    keep their storage and the versions get copied into it instead of swapped, so
+    that the whole step can be captured in a CUDA graph.
+
+    forget_momentum, growing_weights_scale and adv_update_scale are used when not
+    None, and correspond to the forget_momentum, discard_growing_weights and
+    adv_update additional params.
+
+    There's no single step: each of the three passes of a loop has its own grads,
+    applied with retain_step, adversary_step and unlearning_step respectively.
+    """
+
+    def __init__(
+        self,
+        params,
+        retaining_rate,
+        unlearning_rate,
+        retain_momentum,
+        adv_lr,
+        adv_decay,
+        forget_momentum=None,
+        growing_weights_scale=None,
+        adv_update_scale=None,
+        use_masking=True,
+        normalize_grads=True,
+        fixed_storage=False,
+    ):
+        defaults = dict(
+            retaining_rate=retaining_rate,
+            unlearning_rate=unlearning_rate,
+            retain_momentum=retain_momentum,
+            adv_lr=adv_lr,
+            adv_decay=adv_decay,
+            forget_momentum=forget_momentum,
+            growing_weights_scale=growing_weights_scale,
+            adv_update_scale=adv_update_scale,
+            use_masking=use_masking,
+            normalize_grads=normalize_grads,
+        )
+        super().__init__(params, defaults)
+        self.fixed_storage = fixed_storage
+        # which version the params currently hold, "base_data" or "adv_data"
+        self._active = None
+        for p in self._params():
+            state = self.state[p]
+            state["retain_acc"] = pt.zeros_like(p.data)
+            if forget_momentum is not None:
+                state["forget_acc"] = pt.zeros_like(p.data)
+            state["base_data"] = p.data.clone().detach()
+            state["adv_data"] = state["base_data"]
+
+    def _params(self):
+        return [p for group in self.param_groups for p in group["params"]]
+
+    def _states(self, group, key):
+        return [self.state[p][key] for p in group["params"]]
+
+    def set_hyperparams(self, **hyperparams):
+        for group in self.param_groups:
+            for name, value in hyperparams.items():
+                if isinstance(group[name], pt.Tensor):
+                    group[name].fill_(value)
+                else:
+                    group[name] = value
+
+    def reset(self, **hyperparams):
+        """Start over from the params' current values, keeping all the buffers."""
+        self.set_hyperparams(**hyperparams)
+        for p in self._params():
+            state = self.state[p]
+            state["base_data"].copy_(p.data)
+            state["retain_acc"].zero_()
+            if "forget_acc" in state:
+                state["forget_acc"].zero_()
+        self._active = None
+
+    def fork(self, copy=True):
+        """Start the adversary from the base; without copy, it just is the base."""
+        for p in self._params():
+            state = self.state[p]
+            if not copy:
+                state["adv_data"] = state["base_data"]
+            elif self.fixed_storage and state["adv_data"] is not state["base_data"]:
+                state["adv_data"].copy_(state["base_data"])
+            else:
+                state["adv_data"] = state["base_data"].clone().detach()
+
+    def _use(self, key):
+        self._active = key
+        params = self._params()
+        datas = [self.state[p][key] for p in params]
+        if self.fixed_storage:
+            pt._foreach_copy_([p.data for p in params], datas)
+        else:
+            for p, data in zip(params, datas):
+                p.data = data
+
+    def use_base(self):
+        self._use("base_data")
+
+    def use_adversary(self):
+        self._use("adv_data")
+
+    def _sync(self):
+        # with fixed storage, the params hold a copy of the active version,
+        # so after it's updated they need to see the update, like when swapping
+        if self.fixed_storage and self._active is not None:
+            self._use(self._active)
+
+    def step(self, closure=None):
+        raise NotImplementedError(
+            "SurgicalUnlearner has no single step, "
+            "use retain_step, adversary_step and unlearning_step instead"
+        )
+
+    @pt.no_grad()
+    def retain_step(self):
+        """Update disruption scores with the grads on the base, and apply them."""
+        for group in self.param_groups:
+            grads = [p.grad for p in group["params"]]
+            retain_accs = self._states(group, "retain_acc")
+            # ! update disruption scores
+            pt._foreach_mul_(retain_accs, group["retain_momentum"])
+            _add_scaled_(retain_accs, grads, 1 - group["retain_momentum"])
+            # ! retain update
+            base_datas = self._states(group, "base_data")
+            _add_scaled_(base_datas, retain_accs, -group["retaining_rate"])
+        self._sync()
+
+    @pt.no_grad()
+    def adversary_step(self):
+        """Update the adversary with its grads, and decay it into the base."""
+        for group in self.param_groups:
+            grads = [p.grad for p in group["params"]]
+            adv_datas = self._states(group, "adv_data")
+            _add_scaled_(adv_datas, grads, -group["adv_lr"])
+            decay = group["adv_decay"]
+            pt._foreach_mul_(adv_datas, decay)
+            _add_scaled_(adv_datas, self._states(group, "base_data"), 1 - decay)
+        self._sync()
+
+    @pt.no_grad()
+    def unlearning_step(self):
+        """
+        Apply the unlearning grads (taken on the adversary) to the base, masked
+        where they disagree with the disruption scores, and normalized.
+        """
+        for group in self.param_groups:
+            params = group["params"]
+            grads = [p.grad for p in params]
+            # norm of the raw grads, before any masking
+            grad_norm = pt.linalg.vector_norm(pt.stack(pt._foreach_norm(grads)))
+
+            forget_momentum = group["forget_momentum"]
+            if forget_momentum is not None:
+                forget_accs = self._states(group, "forget_acc")
+                pt._foreach_mul_(forget_accs, forget_momentum)
+                _add_scaled_(forget_accs, grads, 1 - forget_momentum)
+                # the accumulators are then masked in place, like grads
+                grads = forget_accs
+
+            if group["use_masking"]:
+                # 1 where signs agree, 0 where they don't or either is 0
+                mask = pt._foreach_sign(self._states(group, "retain_acc"))
+                pt._foreach_mul_(mask, pt._foreach_sign(grads))
+                pt._foreach_clamp_min_(mask, 0)
+                pt._foreach_mul_(grads, mask)
+
+            scale = group["growing_weights_scale"]
+            if scale is not None:
+                for grad, base_data in zip(grads, self._states(group, "base_data")):
+                    growing = base_data.sign() != grad.sign()
+                    grad.mul_(pt.where(growing, scale, 1.0))
+
+            # normalize
+            if group["normalize_grads"]:
+                total_numel = sum(p.numel() for p in params)
+                pt._foreach_mul_(grads, total_numel**0.5 / grad_norm)
+
+            lr = group["unlearning_rate"]
+            _add_scaled_(self._states(group, "base_data"), grads, -lr)
+
+            if group["adv_update_scale"] is not None:
+                adv_datas = self._states(group, "adv_data")
+                _add_scaled_(adv_datas, grads, -lr * group["adv_update_scale"])
+        self._sync()
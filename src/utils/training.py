@@ -1,4 +1,6 @@
+import contextlib
 import logging
+import os
 import random
 
 import numpy as np
@@ -7,19 +9,138 @@ import torch as pt
 from transformers import set_seed as set_transformers_seed
 
 from utils.git_and_reproducibility import *
-from utils.loss_fns import cross_entropy_loss
-
+from utils.loss_fns import cross_entropy_loss, lm_forward
+from utils.profiling import phase
 
 # --- Setup and Environment ---
+# global, like the precision below; applied by set_seeds
+_determinism = "strict"
+
+
+def set_determinism(determinism):
+    """
+    strict: bit-exact reruns, using only deterministic algorithms
+    seeded: seeded, but non-deterministic kernels (e.g. scatter, index_add) allowed
+    fast: also cudnn autotuning and TF32 matmuls, for exploratory sweeps
+    """
+    global _determinism
+    assert determinism in ["strict", "seeded", "fast"], f"unknown {determinism=}"
+    _determinism = determinism
+    if determinism == "strict" and "CUBLAS_WORKSPACE_CONFIG" not in os.environ:
+        # deterministic cuBLAS needs a fixed workspace, which costs throughput,
+        # so it's set only here, and it only applies if CUDA wasn't used yet
+        if pt.cuda.is_initialized():
+            logging.warning("CUDA already in use, so cuBLAS may be non-deterministic")
+        os.environ["CUBLAS_WORKSPACE_CONFIG"] = ":4096:8"
+        # os.environ['CUBLAS_WORKSPACE_CONFIG'] = ":16:8"  # less mem but slower
+
+
+def get_determinism():
+    return _determinism
+
+
 def set_seeds(seed):
     pt.manual_seed(seed)
     pt.cuda.manual_seed_all(seed)
-    pt.backends.cudnn.deterministic = True
-    pt.backends.cudnn.benchmark = False
+    fast = _determinism == "fast"
+    pt.backends.cudnn.deterministic = not fast
+    pt.backends.cudnn.benchmark = fast
+    pt.backends.cuda.matmul.allow_tf32 = fast
     random.seed(seed)
     np.random.seed(seed)
     set_transformers_seed(seed)
-    pt.use_deterministic_algorithms(True)
+    pt.use_deterministic_algorithms(_determinism == "strict")
+    # a new run, so its loss scale doesn't depend on the previous ones
+    _reset_loss_scale()
+
+
+# --- Precision ---
+# global, so that all the loops and evals of a study run in the same precision
+_precision = "fp32"
+# fp16-amp loss scale, adjusted like by torch's GradScaler: halved (and the step
+# skipped) when grads overflow, doubled after _fp16_growth_interval finite ones
+_fp16_init_scale = 2.0**12
+_fp16_growth_interval = 100
+_fp16_loss_scale = _fp16_init_scale
+_fp16_finite_steps = 0
+
+
+def set_precision(precision):
+    """One of fp32, bf16 (autocast with bf16 frozen params) or fp16-amp."""
+    global _precision
+    assert precision in ["fp32", "bf16", "fp16-amp"], f"unknown precision {precision}"
+    _precision = precision
+
+
+def get_precision():
+    return _precision
+
+
+def autocast(cache_enabled=True):
+    """
+    Context for forward passes and losses, running them in the set precision.
+    Pass cache_enabled=False when capturing a CUDA graph.
+    """
+    device_type = pt.get_default_device().type
+    match _precision:
+        case "fp32":
+            return contextlib.nullcontext()
+        case "bf16":
+            return pt.autocast(device_type, pt.bfloat16, cache_enabled=cache_enabled)
+        case "fp16-amp":
+            return pt.autocast(device_type, pt.float16, cache_enabled=cache_enabled)
+
+
+def backward(loss, params, **kwargs):
+    """
+    Like loss.backward(), but in fp16-amp with dynamic loss scaling, and unscaled
+    grads. Returns whether the grads are finite - if not, skip the update.
+    """
+    global _fp16_loss_scale, _fp16_finite_steps
+    if _precision != "fp16-amp":
+        loss.backward(**kwargs)
+        return True
+    (loss * _fp16_loss_scale).backward(**kwargs)
+    grads = [p.grad for p in params if p.grad is not None]
+    found_inf = pt.zeros(1, device=loss.device)
+    inv_scale = pt.full((1,), 1 / _fp16_loss_scale, device=loss.device)
+    pt._amp_foreach_non_finite_check_and_unscale_(grads, found_inf, inv_scale)
+    if found_inf.item():
+        _fp16_loss_scale /= 2
+        _fp16_finite_steps = 0
+        logging.info(f"Grads overflowed, skipping the step, {_fp16_loss_scale=}")
+        return False
+    _fp16_finite_steps += 1
+    if _fp16_finite_steps == _fp16_growth_interval:
+        _fp16_loss_scale *= 2
+        _fp16_finite_steps = 0
+    return True
+
+
+def _reset_loss_scale():
+    global _fp16_loss_scale, _fp16_finite_steps
+    _fp16_loss_scale = _fp16_init_scale
+    _fp16_finite_steps = 0
+
+
+def cast_frozen_params(model, trained_params):
+    """In bf16, store params which aren't trained in bf16, as autocast uses them so."""
+    if _precision != "bf16":
+        return
+    # kept on the model and cast into, so that a reused model's params keep the same
+    # storage in every trial, as a captured CUDA graph needs
+    if not hasattr(model, "_bf16_params"):
+        model._bf16_params = {}
+    trained_ids = [id(p) for p in trained_params]
+    for name, p in model.named_parameters():
+        if id(p) in trained_ids:
+            continue
+        bf16_data = model._bf16_params.get(name)
+        if bf16_data is None or bf16_data.shape != p.shape:
+            bf16_data = pt.empty_like(p.data, dtype=pt.bfloat16)
+            model._bf16_params[name] = bf16_data
+        bf16_data.copy_(p.data)
+        p.data = bf16_data
 
 
 # --- Mock Trial for Optuna ---
@@ -40,13 +161,39 @@ class MockTrial:
     def set_user_attr(self, *args, **kwargs):
         pass
 
+    def report(self, *args, **kwargs):
+        pass
+
+    def should_prune(self):
+        return False
+
 
-def eval_(model, f_eval_batch, r_eval_batch, allowed_r_loss=None, step=""):
+def get_pruner(config):
+    """Pruner set in general_config, e.g. `pruner: median`, and its `pruner_kwargs`."""
+    pruner_kwargs = getattr(config, "pruner_kwargs", {})
+    match getattr(config, "pruner", None):
+        case None:
+            return optuna.pruners.NopPruner()
+        case "median":
+            return optuna.pruners.MedianPruner(**pruner_kwargs)
+        case "successive_halving":
+            return optuna.pruners.SuccessiveHalvingPruner(**pruner_kwargs)
+        case "hyperband":
+            return optuna.pruners.HyperbandPruner(**pruner_kwargs)
+        case pruner_name:
+            raise ValueError(f"unknown pruner {pruner_name}")
+
+
+def eval_(model, f_eval_batch, r_eval_batch, allowed_r_loss=None, step="", trial=None):
     model.eval()
-    with pt.no_grad():
+    with phase("eval"), pt.no_grad(), autocast():
         res = dict(
-            forget_loss=cross_entropy_loss(model(f_eval_batch), f_eval_batch),
-            retain_loss=cross_entropy_loss(model(r_eval_batch), r_eval_batch),
+            forget_loss=cross_entropy_loss(
+                lm_forward(model, f_eval_batch), f_eval_batch
+            ),
+            retain_loss=cross_entropy_loss(
+                lm_forward(model, r_eval_batch), r_eval_batch
+            ),
         )
     logging.info(f"{step:4} " + " ".join(f"{v:11.3f}" for v in res.values()))
     if any(pt.isnan(v) for v in res.values()):
@@ -56,6 +203,12 @@ def eval_(model, f_eval_batch, r_eval_batch, allowed_r_loss=None, step=""):
         logging.info(f"Pruning trial because retain loss is too high")
         raise optuna.TrialPruned()
 
+    if trial is not None:
+        trial.report(res["forget_loss"].item(), step)
+        if trial.should_prune():
+            logging.info(f"Pruning trial because the pruner decided so")
+            raise optuna.TrialPruned()
+
     return res
 
 